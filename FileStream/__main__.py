@@ -9,7 +9,10 @@ from pyrogram import idle
 
 from FileStream.bot import FileStream
 from FileStream.server import web_server
+from FileStream.server.cluster import cluster
 from FileStream.bot.clients import initialize_clients
+from FileStream.utils.database import db
+from FileStream.utils.broadcast_helper import resume_broadcasts
 
 logging.basicConfig(
     level=logging.INFO,
@@ -35,12 +38,15 @@ async def start_services():
     print()
     print("-------------------- Initializing Telegram Bot --------------------")
 
+    await db.create_indexes()
 
     await FileStream.start()
     bot_info = await FileStream.get_me()
     FileStream.id = bot_info.id
     FileStream.username = bot_info.username
     FileStream.fname=bot_info.first_name
+    if not Telegram.SECONDARY:
+        await resume_broadcasts(FileStream)
     print("------------------------------ DONE ------------------------------")
     print()
     print("---------------------- Initializing Clients ----------------------")
@@ -50,6 +56,7 @@ async def start_services():
     print("--------------------- Initializing Web Server ---------------------")
     await server.setup()
     await web.TCPSite(server, Server.BIND_ADDRESS, Server.PORT).start()
+    cluster.start()
     print("------------------------------ DONE ------------------------------")
     print()
     print("------------------------- Service Started -------------------------")
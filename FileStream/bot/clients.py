@@ -1,9 +1,10 @@
 import asyncio
 import logging
 from os import environ
-from ..config import Telegram
+from ..config import Telegram, Server
 from pyrogram import Client
 from . import multi_clients, work_loads, FileStream
+from ..utils.media_session import get_media_pool
 
 
 async def initialize_clients():
@@ -19,6 +20,7 @@ async def initialize_clients():
         multi_clients[0] = FileStream
         work_loads[0] = 0
         print("No additional clients found, using default client")
+        await warm_media_sessions()
         return
     
     async def start_client(client_id, token):
@@ -57,3 +59,11 @@ async def initialize_clients():
         print("Multi-Client Mode Enabled")
     else:
         print("No additional clients were initialized, using default client")
+    await warm_media_sessions()
+
+
+async def warm_media_sessions():
+    if not Server.PREWARM_MEDIA_SESSIONS:
+        return
+    print("Pre-warming media sessions, this may take a while...")
+    await asyncio.gather(*[get_media_pool(client).warm() for client in multi_clients.values()])
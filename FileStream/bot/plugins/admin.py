@@ -1,13 +1,5 @@
-import os
-import time
-import string
-import random
-import asyncio
-import aiofiles
-import datetime
-
-from FileStream.utils.broadcast_helper import send_msg
-from FileStream.utils.database import Database
+from FileStream.utils.broadcast_helper import Broadcast, broadcast_ids
+from FileStream.utils.database import db
 from FileStream.bot import FileStream
 from FileStream.server.exceptions import FIleNotFound
 from FileStream.config import Telegram, Server
@@ -15,9 +7,6 @@ from pyrogram import filters, Client
 from pyrogram.types import Message
 from pyrogram.enums.parse_mode import ParseMode
 
-db = Database(Telegram.DATABASE_URL, Telegram.SESSION_NAME)
-broadcast_ids = {}
-
 
 @FileStream.on_message(filters.command("status") & filters.private & filters.user(Telegram.OWNER_ID))
 async def sts(c: Client, m: Message):
@@ -70,72 +59,25 @@ async def sts(b, m: Message):
 
 @FileStream.on_message(filters.command("broadcast") & filters.private & filters.user(Telegram.OWNER_ID) & filters.reply)
 async def broadcast_(c, m):
-    all_users = await db.get_all_users()
-    broadcast_msg = m.reply_to_message
-    while True:
-        broadcast_id = ''.join([random.choice(string.ascii_letters) for i in range(3)])
-        if not broadcast_ids.get(broadcast_id):
-            break
     out = await m.reply_text(
         text=f"Broadcast initiated! You will be notified with log file when all the users are notified."
     )
-    start_time = time.time()
-    total_users = await db.total_users_count()
-    done = 0
-    failed = 0
-    success = 0
-    broadcast_ids[broadcast_id] = dict(
-        total=total_users,
-        current=done,
-        failed=failed,
-        success=success
-    )
-    async with aiofiles.open('broadcast.txt', 'w') as broadcast_log_file:
-        async for user in all_users:
-            sts, msg = await send_msg(
-                user_id=int(user['id']),
-                message=broadcast_msg
-            )
-            if msg is not None:
-                await broadcast_log_file.write(msg)
-            if sts == 200:
-                success += 1
-            else:
-                failed += 1
-            if sts == 400:
-                await db.delete_user(user['id'])
-            done += 1
-            if broadcast_ids.get(broadcast_id) is None:
-                break
-            else:
-                broadcast_ids[broadcast_id].update(
-                    dict(
-                        current=done,
-                        failed=failed,
-                        success=success
-                    )
-                )
-                try:
-                    await out.edit_text(f"Broadcast Status\n\ncurrent: {done}\nfailed:{failed}\nsuccess: {success}")
-                except:
-                    pass
-    if broadcast_ids.get(broadcast_id):
-        broadcast_ids.pop(broadcast_id)
-    completed_in = datetime.timedelta(seconds=int(time.time() - start_time))
-    await asyncio.sleep(3)
-    await out.delete()
-    if failed == 0:
-        await m.reply_text(
-            text=f"broadcast completed in `{completed_in}`\n\nTotal users {total_users}.\nTotal done {done}, {success} success and {failed} failed.",
-            quote=True
-        )
-    else:
-        await m.reply_document(
-            document='broadcast.txt',
-            caption=f"broadcast completed in `{completed_in}`\n\nTotal users {total_users}.\nTotal done {done}, {success} success and {failed} failed.",
-            quote=True
-        )
-    os.remove('broadcast.txt')
+    broadcast = await Broadcast.create(c, m, m.reply_to_message, out)
+    broadcast.start()
+    await out.edit_text(f"Broadcast `{broadcast.state['_id']}` initiated! You will be notified with log file when all the users are notified.\n\nSend `/cancel_broadcast {broadcast.state['_id']}` to stop it.")
+
+
+@FileStream.on_message(filters.command("cancel_broadcast") & filters.private & filters.user(Telegram.OWNER_ID))
+async def cancel_broadcast(c: Client, m: Message):
+    if len(m.command) < 2:
+        await m.reply_text("Usage: `/cancel_broadcast <id>`", quote=True)
+        return
+    broadcast = broadcast_ids.get(m.command[1])
+    if broadcast is None:
+        await m.reply_text(f"`{m.command[1]}`** is not a running broadcast**", parse_mode=ParseMode.MARKDOWN, quote=True)
+        return
+    broadcast.cancel()
+    await m.reply_text(f"Broadcast `{m.command[1]}` will stop after the current batch", quote=True)
 
 
 @FileStream.on_message(filters.command("del") & filters.private & filters.user(Telegram.OWNER_ID))
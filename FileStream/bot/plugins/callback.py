@@ -5,13 +5,12 @@ from FileStream.bot import FileStream
 from FileStream.config import Telegram, Server
 from FileStream.utils.translation import LANG, BUTTON
 from FileStream.utils.bot_utils import gen_link
-from FileStream.utils.database import Database
+from FileStream.utils.database import db
 from FileStream.utils.human_readable import humanbytes
 from FileStream.server.exceptions import FIleNotFound
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from pyrogram.file_id import FileId, FileType, PHOTO_TYPES
 from pyrogram.enums.parse_mode import ParseMode
-db = Database(Telegram.DATABASE_URL, Telegram.SESSION_NAME)
 
 #---------------------[ START CMD ]---------------------#
 @FileStream.on_callback_query()
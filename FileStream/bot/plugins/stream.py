@@ -1,16 +1,14 @@
 import asyncio
 from FileStream.bot import FileStream, multi_clients
 from FileStream.utils.bot_utils import is_user_banned, is_user_exist, is_user_joined, gen_link, is_channel_banned, is_channel_exist, is_user_authorized
-from FileStream.utils.database import Database, FIleNotFound
-from FileStream.utils.file_properties import get_file_ids, get_file_info
+from FileStream.utils.database import FIleNotFound
+from FileStream.utils.file_properties import add_file
 from FileStream.config import Telegram
 from pyrogram import filters, Client
 from pyrogram.errors import FloodWait
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from pyrogram.enums.parse_mode import ParseMode
 
-db = Database(Telegram.DATABASE_URL, Telegram.SESSION_NAME)
-
 @FileStream.on_message(
     filters.private
     & (
@@ -35,8 +33,7 @@ async def private_receive_handler(bot: Client, message: Message):
         if not await is_user_joined(bot, message):
             return
     try:
-        inserted_id = await db.add_file(get_file_info(message))
-        await get_file_ids(False, inserted_id, multi_clients, message)
+        inserted_id = await add_file(message, multi_clients)
         reply_markup, stream_text = await gen_link(_id=inserted_id)
         await message.reply_text(
             text=stream_text,
@@ -74,8 +71,7 @@ async def channel_receive_handler(bot: Client, message: Message):
     await is_channel_exist(bot, message)
 
     try:
-        inserted_id = await db.add_file(get_file_info(message))
-        await get_file_ids(False, inserted_id, multi_clients, message)
+        inserted_id = await add_file(message, multi_clients)
         reply_markup, stream_link = await gen_link(_id=inserted_id)
         await bot.edit_message_reply_markup(
             chat_id=message.chat.id,
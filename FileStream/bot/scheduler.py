@@ -0,0 +1,157 @@
+import time
+import hashlib
+import logging
+from collections import deque
+from typing import Dict, Iterable, Optional
+from FileStream.config import Server
+from . import work_loads
+
+
+class ClientStats:
+    """
+    Live health of one client: smoothed GetFile latency and per-request rate,
+    error ratio, bytes in flight and the cooldown set by FloodWaits or errors.
+    """
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.rate: Optional[float] = None
+        self.error_ratio = 0.0
+        self.consecutive_errors = 0
+        self.flood_waits = 0
+        self.inflight_bytes = 0
+        self.cooldown_until = 0.0
+        self.served = deque()
+        self.served_bytes = 0
+
+    def prune(self, cutoff: float):
+        while self.served and self.served[0][0] < cutoff:
+            self.served_bytes -= self.served.popleft()[1]
+
+    def throughput(self, window: float) -> float:
+        """
+        Bytes per second fetched over the last `window` seconds.
+        """
+        self.prune(time.monotonic() - window)
+        return self.served_bytes / window
+
+
+class ClientScheduler:
+    """
+    Picks the client that should serve the next stream by a weighted score
+    instead of the raw number of open streams.
+    """
+    ALPHA = 0.2  # weight of the newest sample in the moving averages
+    DEFAULT_LATENCY = 0.5  # seconds, assumed for clients without samples
+    DEFAULT_RATE = 1024 * 1024  # bytes per second, assumed for clients without samples
+    ERROR_PENALTY = 4.0
+    ERROR_COOLDOWN = 10.0  # seconds per consecutive error
+    MAX_ERROR_COOLDOWN = 120.0
+    THROUGHPUT_WINDOW = 10.0
+
+    def __init__(self):
+        self.stats: Dict[int, ClientStats] = {}
+
+    def get(self, index: int) -> ClientStats:
+        if index not in self.stats:
+            self.stats[index] = ClientStats()
+        return self.stats[index]
+
+    def score(self, index: int) -> float:
+        """
+        Estimated seconds until the client could deliver a new chunk, lower is better.
+        Besides its open streams, a client is charged for the live throughput it is
+        pushing, counted in requests' worth of its per-request rate, so streams that
+        are actually downloading weigh more than paused players.
+        """
+        stats = self.get(index)
+        latency = stats.latency if stats.latency is not None else self.DEFAULT_LATENCY
+        rate = stats.rate if stats.rate else self.DEFAULT_RATE
+        busy = stats.throughput(self.THROUGHPUT_WINDOW) / rate
+        expected = latency * (1 + work_loads.get(index, 0) + busy) + stats.inflight_bytes / rate
+        return expected * (1 + self.ERROR_PENALTY * stats.error_ratio)
+
+    def pick(self, candidates: Iterable[int] = None, key: str = None) -> int:
+        """
+        Returns the client with the best score. With a `key` (a file's db_id) the
+        choice is limited to the key's affinity clients, so the range requests of
+        one playback reuse the same cached properties and warm media sessions,
+        unless all of them are unavailable or far behind the best client.
+        """
+        candidates = list(work_loads if candidates is None else candidates)
+        now = time.monotonic()
+        available = [i for i in candidates if self.get(i).cooldown_until <= now]
+        if not available:
+            # Everyone is penalized, take the one that recovers first
+            return min(candidates, key=lambda i: self.get(i).cooldown_until)
+        best = min(available, key=self.score)
+        if key is None or Server.AFFINITY_CLIENTS <= 0:
+            return best
+
+        preferred = [i for i in self.affinity(key, candidates) if i in available]
+        if preferred:
+            choice = min(preferred, key=self.score)
+            if self.score(choice) <= Server.AFFINITY_SPILLOVER * self.score(best):
+                return choice
+        return best
+
+    @staticmethod
+    def affinity(key: str, candidates: Iterable[int]) -> list:
+        """
+        Rendezvous hashing: the AFFINITY_CLIENTS candidates with the highest weight
+        for `key`. Adding or removing a client only moves the keys that ranked it.
+        """
+        def weight(index: int) -> int:
+            return int.from_bytes(hashlib.blake2b(f"{key}:{index}".encode(), digest_size=8).digest(), "big")
+
+        return sorted(candidates, key=weight, reverse=True)[:Server.AFFINITY_CLIENTS]
+
+    def begin_fetch(self, index: int, nbytes: int):
+        self.get(index).inflight_bytes += nbytes
+
+    def end_fetch(self, index: int, nbytes: int):
+        self.get(index).inflight_bytes -= nbytes
+
+    def record_chunk(self, index: int, nbytes: int, seconds: float):
+        stats = self.get(index)
+        seconds = max(seconds, 1e-3)
+        stats.latency = seconds if stats.latency is None else (1 - self.ALPHA) * stats.latency + self.ALPHA * seconds
+        rate = nbytes / seconds
+        stats.rate = rate if stats.rate is None else (1 - self.ALPHA) * stats.rate + self.ALPHA * rate
+        stats.error_ratio *= 1 - self.ALPHA
+        stats.consecutive_errors = 0
+        now = time.monotonic()
+        stats.served.append((now, nbytes))
+        stats.served_bytes += nbytes
+        stats.prune(now - self.THROUGHPUT_WINDOW)
+
+    def record_error(self, index: int):
+        stats = self.get(index)
+        stats.error_ratio = (1 - self.ALPHA) * stats.error_ratio + self.ALPHA
+        stats.consecutive_errors += 1
+        cooldown = min(self.ERROR_COOLDOWN * stats.consecutive_errors, self.MAX_ERROR_COOLDOWN)
+        stats.cooldown_until = max(stats.cooldown_until, time.monotonic() + cooldown)
+
+    def record_flood_wait(self, index: int, seconds: float):
+        stats = self.get(index)
+        stats.flood_waits += 1
+        stats.cooldown_until = max(stats.cooldown_until, time.monotonic() + seconds)
+        logging.warning(f"Client {index} is flood limited for {seconds}s, removed from rotation")
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {
+            index: {
+                "score": round(self.score(index), 3),
+                "latency": round(stats.latency, 3) if stats.latency is not None else None,
+                "throughput": round(stats.throughput(self.THROUGHPUT_WINDOW)),
+                "inflight_bytes": stats.inflight_bytes,
+                "error_ratio": round(stats.error_ratio, 3),
+                "flood_waits": stats.flood_waits,
+                "cooldown": round(max(stats.cooldown_until - now, 0), 1),
+            }
+            for index, stats in self.stats.items()
+        }
+
+
+scheduler = ClientScheduler()
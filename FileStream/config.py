@@ -28,6 +28,12 @@ class Telegram:
     MODE = env.get("MODE", "primary")
     SECONDARY = True if MODE.lower() == "secondary" else False
     AUTH_USERS = list(set(int(x) for x in str(env.get("AUTH_USERS", "")).split()))
+    FILE_ID_CONCURRENCY = int(env.get("FILE_ID_CONCURRENCY", "8"))  # clients resolving a new file at once
+    FILE_ID_TIMEOUT = float(env.get("FILE_ID_TIMEOUT", "5"))  # seconds a client may take before it is left to on-demand resolution
+    BROADCAST_RATE = float(env.get("BROADCAST_RATE", "25"))  # messages per second, Telegram allows about 30
+    BROADCAST_WORKERS = int(env.get("BROADCAST_WORKERS", "20"))
+    BROADCAST_BATCH = int(env.get("BROADCAST_BATCH", "200"))  # users between checkpoints
+    BROADCAST_PROGRESS_INTERVAL = int(env.get("BROADCAST_PROGRESS_INTERVAL", "15"))  # seconds between status edits
 
     # Nuevo: indicar si se usará almacenamiento local
     USE_LOCAL_DB = DATABASE_URL is None
@@ -43,3 +49,57 @@ class Server:
     URL = "http{}://{}{}/".format(
         "s" if HAS_SSL else "", FQDN, "" if NO_PORT else ":" + str(PORT)
     )
+
+    # Read-ahead: GetFile requests kept in flight per stream, capped by buffered bytes
+    READ_AHEAD = int(env.get("READ_AHEAD", "4"))
+    READ_AHEAD_MAX_BYTES = int(env.get("READ_AHEAD_MAX_BYTES", str(8 * 1024 * 1024)))
+
+    # Shared on-disk cache of streamed chunks, 0 disables it
+    CHUNK_CACHE_DIR = str(env.get("CHUNK_CACHE_DIR", "FileStream/cache"))
+    CHUNK_CACHE_SIZE = int(env.get("CHUNK_CACHE_SIZE", "0"))
+
+    # Cached file properties per client: max entries and seconds to live
+    FILE_CACHE_SIZE = int(env.get("FILE_CACHE_SIZE", "10000"))
+    FILE_CACHE_TTL = int(env.get("FILE_CACHE_TTL", "1800"))
+
+    # Media sessions per DC and client, optional pre-warming at startup and keepalive in seconds
+    MEDIA_SESSIONS_PER_DC = int(env.get("MEDIA_SESSIONS_PER_DC", "2"))
+    PREWARM_MEDIA_SESSIONS = str(env.get("PREWARM_MEDIA_SESSIONS", "0").lower()) in ("1", "true", "t", "yes", "y")
+    MEDIA_SESSION_KEEPALIVE = int(env.get("MEDIA_SESSION_KEEPALIVE", "300"))
+    MEDIA_SESSION_TIMEOUT = int(env.get("MEDIA_SESSION_TIMEOUT", "10"))
+
+    # Clients a file sticks to, 0 disables affinity, and how much worse their score may be than the best client's
+    AFFINITY_CLIENTS = int(env.get("AFFINITY_CLIENTS", "2"))
+    AFFINITY_SPILLOVER = float(env.get("AFFINITY_SPILLOVER", "3"))
+
+    # Rendered /watch pages kept in memory: max entries and seconds to live
+    PAGE_CACHE_SIZE = int(env.get("PAGE_CACHE_SIZE", "1000"))
+    PAGE_CACHE_TTL = int(env.get("PAGE_CACHE_TTL", "600"))
+
+    # Byte budget for the pinned container indexes (MP4 moov, Matroska Cues) of played files, 0 disables it
+    INDEX_CACHE_SIZE = int(env.get("INDEX_CACHE_SIZE", str(64 * 1024 * 1024)))
+
+    # Egress shaping of /dl: open streams per IP and bytes per second per IP and in total (0 disables each),
+    # and the share of bandwidth of interactive playback relative to downloads under the global cap
+    MAX_CONNECTIONS_PER_IP = int(env.get("MAX_CONNECTIONS_PER_IP", "0"))
+    IP_RATE_LIMIT = int(env.get("IP_RATE_LIMIT", "0"))
+    GLOBAL_RATE_LIMIT = int(env.get("GLOBAL_RATE_LIMIT", "0"))
+    INTERACTIVE_WEIGHT = float(env.get("INTERACTIVE_WEIGHT", "4"))
+    # Addresses or networks of the reverse proxies whose X-Forwarded-For is trusted, comma separated
+    TRUSTED_PROXIES = [proxy.strip() for proxy in str(env.get("TRUSTED_PROXIES", "")).split(",") if proxy.strip()]
+
+    # Cache-Control sent with /dl per mime class and with /watch pages
+    CACHE_CONTROL_VIDEO = str(env.get("CACHE_CONTROL_VIDEO", "public, max-age=86400"))
+    CACHE_CONTROL_AUDIO = str(env.get("CACHE_CONTROL_AUDIO", "public, max-age=86400"))
+    CACHE_CONTROL_IMAGE = str(env.get("CACHE_CONTROL_IMAGE", "public, max-age=86400"))
+    CACHE_CONTROL_DEFAULT = str(env.get("CACHE_CONTROL_DEFAULT", "public, max-age=86400"))
+    CACHE_CONTROL_WATCH = str(env.get("CACHE_CONTROL_WATCH", "public, max-age=300"))
+
+    # Cluster mode: nodes publish their load and hot files to the database and /dl may redirect to a peer
+    CLUSTER_MODE = str(env.get("CLUSTER_MODE", "0").lower()) in ("1", "true", "t", "yes", "y")
+    NODE_ID = str(env.get("NODE_ID", "")) or "{}:{}".format(FQDN, PORT)
+    NODE_URL = str(env.get("NODE_URL", URL))
+    CLUSTER_HEARTBEAT = int(env.get("CLUSTER_HEARTBEAT", "10"))  # seconds between load reports
+    CLUSTER_NODE_TTL = int(env.get("CLUSTER_NODE_TTL", "30"))  # seconds before a silent node is ignored
+    CLUSTER_HOT_FILES = int(env.get("CLUSTER_HOT_FILES", "500"))  # recently streamed files published per node
+    CLUSTER_SPILLOVER = float(env.get("CLUSTER_SPILLOVER", "2"))  # load ratio over the least loaded peer that triggers a redirect
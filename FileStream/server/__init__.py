@@ -1,7 +1,7 @@
 from aiohttp import web
-from .stream_routes import routes
+from .stream_routes import routes, metrics_middleware
 
 def web_server():
-    web_app = web.Application(client_max_size=30000000)
+    web_app = web.Application(client_max_size=30000000, middlewares=[metrics_middleware])
     web_app.add_routes(routes)
     return web_app
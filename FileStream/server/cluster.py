@@ -0,0 +1,115 @@
+import time
+import asyncio
+import logging
+import urllib.parse
+from collections import OrderedDict
+from typing import Optional
+from FileStream.bot import work_loads
+from FileStream.config import Server
+from FileStream.utils.database import Database, db
+
+
+class Cluster:
+    """
+    Coordination between FileStream nodes serving the same bots. Every node
+    publishes its load and the files it streamed recently to the database on an
+    interval, and keeps the last view of its live peers in memory, so deciding
+    where a /dl request should go never waits on the database.
+    With the local database the node list stays in process, which lets several
+    Cluster instances be exercised together without MongoDB.
+    """
+
+    def __init__(self, database: Database, node_id: str, url: str, enabled: bool = True):
+        self.database = database
+        self.node_id = node_id
+        self.url = url
+        self.enabled = enabled
+        self.hot_files: "OrderedDict[str, float]" = OrderedDict()
+        self.peers = {}
+        self.task = None
+
+    def touch(self, db_id: str):
+        """
+        Marks a file as streamed by this node.
+        """
+        self.hot_files[db_id] = time.time()
+        self.hot_files.move_to_end(db_id)
+        while len(self.hot_files) > Server.CLUSTER_HOT_FILES:
+            self.hot_files.popitem(last=False)
+
+    def load(self) -> float:
+        """
+        Open streams per client of this node.
+        """
+        return sum(work_loads.values()) / max(len(work_loads), 1)
+
+    def node_info(self) -> dict:
+        return {
+            "_id": self.node_id,
+            "url": self.url,
+            "clients": len(work_loads),
+            "streams": sum(work_loads.values()),
+            "load": self.load(),
+            "hot_files": list(self.hot_files),
+            "updated": time.time(),
+        }
+
+    async def heartbeat(self):
+        await self.database.save_node(self.node_info())
+        nodes = await self.database.get_nodes(time.time() - Server.CLUSTER_NODE_TTL)
+        self.peers = {
+            node["_id"]: dict(node, hot_files=set(node.get("hot_files", [])))
+            for node in nodes
+            if node["_id"] != self.node_id and node.get("clients")
+        }
+
+    async def run(self):
+        while True:
+            try:
+                await self.heartbeat()
+            except Exception:
+                logging.warning("Cluster heartbeat failed", exc_info=True)
+            await asyncio.sleep(Server.CLUSTER_HEARTBEAT)
+
+    def start(self):
+        if self.enabled and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def redirect_target(self, db_id: str) -> Optional[dict]:
+        """
+        Returns the peer that should serve a new stream of `db_id`, or None to serve it here.
+        A file this node already streams stays here. Otherwise the least loaded peer
+        that streams it takes it, as long as that peer is not busier than this node,
+        and failing that, once this node has a couple of streams per client, any peer
+        carrying CLUSTER_SPILLOVER times less load per client.
+        """
+        if not self.enabled or not self.peers or db_id in self.hot_files:
+            return None
+        load = self.load()
+        holders = [peer for peer in self.peers.values() if db_id in peer["hot_files"]]
+        if holders:
+            peer = min(holders, key=lambda peer: peer["load"])
+            if peer["load"] <= load:
+                return peer
+        peer = min(self.peers.values(), key=lambda peer: peer["load"])
+        if load >= 2 and load >= Server.CLUSTER_SPILLOVER * max(peer["load"], 1):
+            return peer
+        return None
+
+    def redirect_url(self, peer: dict, path: str, query_string: str) -> str:
+        return urllib.parse.urljoin(peer["url"], path.lstrip("/")) + (f"?{query_string}" if query_string else "")
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        return {
+            "node": self.node_id,
+            "load": round(self.load(), 2),
+            "hot_files": len(self.hot_files),
+            "peers": {
+                node_id: {"url": peer["url"], "load": round(peer["load"], 2), "age": round(now - peer["updated"], 1)}
+                for node_id, peer in self.peers.items()
+            },
+        }
+
+
+cluster = Cluster(db, Server.NODE_ID, Server.NODE_URL, Server.CLUSTER_MODE)
@@ -2,4 +2,7 @@ class InvalidHash(Exception):
     message = "Invalid hash"
 
 class FIleNotFound(Exception):
-    message = "File not found"
\ No newline at end of file
+    message = "File not found"
+
+class RangeNotSatisfiable(Exception):
+    message = "Range not satisfiable"
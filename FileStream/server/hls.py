@@ -0,0 +1,24 @@
+import math
+from FileStream.utils.container import SegmentIndex
+
+
+def render_playlist(index: SegmentIndex, url: str) -> str:
+    """
+    HLS media playlist whose initialization section and segments are byte ranges
+    of the original file at `url`, so nothing is remuxed or transcoded.
+    """
+    target_duration = max((math.ceil(duration) for _, _, duration in index.segments), default=1)
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:7",
+        f"#EXT-X-TARGETDURATION:{target_duration}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+        f'#EXT-X-MAP:URI="{url}",BYTERANGE="{index.init_size}@0"',
+    ]
+    for offset, size, duration in index.segments:
+        lines.append(f"#EXTINF:{duration:.3f},")
+        lines.append(f"#EXT-X-BYTERANGE:{size}@{offset}")
+        lines.append(url)
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
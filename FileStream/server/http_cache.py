@@ -0,0 +1,56 @@
+import hashlib
+from typing import Optional
+from email.utils import formatdate, parsedate_to_datetime
+from aiohttp import web
+from FileStream.config import Server
+
+
+def file_etag(unique_id: str, file_size: int) -> str:
+    """
+    Strong ETag of a stored file: the same Telegram media always has the same bytes.
+    """
+    return f'"{unique_id}-{file_size}"'
+
+
+def content_etag(content: str) -> str:
+    return '"{}"'.format(hashlib.sha1(content.encode()).hexdigest()[:20])
+
+
+def http_date(timestamp: Optional[float]) -> Optional[str]:
+    if not timestamp:
+        return None
+    return formatdate(timestamp, usegmt=True)
+
+
+def cache_control(mime_type: Optional[str]) -> str:
+    """
+    Cache-Control policy for a mime class, configurable through Server.CACHE_CONTROL_*.
+    """
+    main_type = str(mime_type).split("/")[0]
+    if main_type == "video":
+        return Server.CACHE_CONTROL_VIDEO
+    if main_type == "audio":
+        return Server.CACHE_CONTROL_AUDIO
+    if main_type == "image":
+        return Server.CACHE_CONTROL_IMAGE
+    return Server.CACHE_CONTROL_DEFAULT
+
+
+def is_not_modified(request: web.Request, etag: str, last_modified: Optional[str] = None) -> bool:
+    """
+    Evaluates If-None-Match (weak comparison) and, when it is absent, If-Modified-Since.
+    """
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return True
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag.removeprefix("W/") in tags
+
+    if_modified_since = request.headers.get("If-Modified-Since")
+    if if_modified_since and last_modified:
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
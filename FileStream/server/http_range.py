@@ -0,0 +1,93 @@
+import re
+from typing import List, Optional, Tuple
+from email.utils import parsedate_to_datetime
+from FileStream.server.exceptions import RangeNotSatisfiable
+
+MAX_RANGES = 16
+# Ranges closer than this are fetched from Telegram as one span
+COALESCE_GAP = 1024 * 1024
+# ASCII digits only: str.isdigit() also accepts e.g. "²", which int() rejects
+RANGE_SPEC = re.compile(r"\s*([0-9]*)\s*-\s*([0-9]*)\s*")
+
+
+def parse_range(header: Optional[str], file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses a Range header into sorted, merged, inclusive (start, end) byte ranges.
+    Supports "a-b", open "a-" and suffix "-n" specs, comma separated.
+    Returns None when the whole file should be served (no header, another unit or
+    a malformed header, which RFC 9110 says to ignore) and raises RangeNotSatisfiable
+    when none of the ranges overlaps the file.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs.strip():
+        return None
+
+    ranges = []
+    for spec in specs.split(","):
+        match = RANGE_SPEC.fullmatch(spec)
+        if match is None or not any(match.groups()):
+            return None
+        start, end = match.groups()
+        if not start:
+            suffix = int(end)
+            if suffix == 0 or file_size == 0:
+                continue
+            ranges.append((max(file_size - suffix, 0), file_size - 1))
+            continue
+        start = int(start)
+        if start >= file_size:
+            continue
+        end = int(end) if end else file_size - 1
+        if end < start:
+            return None
+        ranges.append((start, min(end, file_size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+def plan_fetches(ranges: List[Tuple[int, int]], gap: int = COALESCE_GAP) -> List[Tuple[int, int, List[Tuple[int, int]]]]:
+    """
+    Groups sorted ranges into upstream spans (start, end, ranges) so that ranges
+    separated by less than `gap` bytes share a single sequential fetch.
+    """
+    plan = []
+    for start, end in ranges:
+        if plan and start - plan[-1][1] - 1 < gap:
+            plan[-1] = (plan[-1][0], end, plan[-1][2] + [(start, end)])
+        else:
+            plan.append((start, end, [(start, end)]))
+    return plan
+
+
+def if_range_matches(if_range: Optional[str], etag: Optional[str] = None, last_modified: Optional[str] = None) -> bool:
+    """
+    Evaluates If-Range: a strong ETag must match exactly, a date must equal Last-Modified.
+    Without a validator to compare against the Range header has to be ignored.
+    """
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return etag is not None and not if_range.startswith("W/") and if_range == etag
+    if last_modified is None:
+        return False
+    try:
+        return parsedate_to_datetime(if_range) == parsedate_to_datetime(last_modified)
+    except (TypeError, ValueError):
+        return False
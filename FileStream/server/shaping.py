@@ -0,0 +1,164 @@
+import heapq
+import asyncio
+import logging
+import ipaddress
+import itertools
+from typing import Optional
+from aiohttp import web
+from FileStream.config import Server
+from FileStream.utils.rate_limit import TokenBucket
+from FileStream.utils.metrics import SHAPER_REJECTIONS, SHAPER_DELAYED_BYTES
+
+# Chunks are at most 1 MiB, every bucket must be able to hold one
+MIN_BURST = 1024 * 1024
+
+
+def parse_networks(proxies) -> list:
+    networks = []
+    for proxy in proxies:
+        try:
+            networks.append(ipaddress.ip_network(proxy, strict=False))
+        except ValueError:
+            logging.warning(f"Ignoring invalid TRUSTED_PROXIES entry {proxy!r}")
+    return networks
+
+
+TRUSTED_NETWORKS = parse_networks(Server.TRUSTED_PROXIES)
+
+
+def is_trusted(address: str, networks: list) -> bool:
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+
+def client_ip(request: web.Request, networks: list = None) -> str:
+    """
+    Address of the client, from X-Forwarded-For only when the peer is a trusted proxy.
+    The rightmost forwarded address that is not itself a trusted proxy is the client,
+    the addresses left of it were supplied by the client and are ignored.
+    """
+    networks = TRUSTED_NETWORKS if networks is None else networks
+    address = request.remote or ""
+    if not is_trusted(address, networks):
+        return address
+    forwarded = [hop.strip() for hop in request.headers.get("X-FORWARDED-FOR", "").split(",") if hop.strip()]
+    for hop in reversed(forwarded):
+        address = hop
+        if not is_trusted(hop, networks):
+            break
+    return address
+
+
+def is_interactive(request: web.Request) -> bool:
+    """
+    Playback in a <video>/<audio> element, e.g. on /watch, as opposed to a download.
+    """
+    return (
+        request.headers.get("Sec-Fetch-Dest") in ("video", "audio")
+        or "/watch/" in request.headers.get("Referer", "")
+    )
+
+
+class Stream:
+    def __init__(self, ip: str, interactive: bool, weight: float):
+        self.ip = ip
+        self.priority = "interactive" if interactive else "bulk"
+        self.weight = weight
+        self.finish = 0.0
+
+
+class Shaper:
+    """
+    Egress shaper of /dl streams. Limits the streams open per IP, the bytes per
+    second of each IP and the bytes per second of the whole node, every rate a
+    token bucket. Under the global cap, chunks waiting for tokens are released
+    in weighted fair queuing order (self-clocked virtual finish times), so
+    interactive playback gets INTERACTIVE_WEIGHT times the share of a download
+    and a client opening many connections cannot starve the others.
+    """
+
+    def __init__(self, max_connections: int, ip_rate: float, global_rate: float, interactive_weight: float):
+        self.max_connections = max_connections
+        self.ip_rate = ip_rate
+        self.interactive_weight = interactive_weight
+        self.bucket = TokenBucket(global_rate, max(global_rate, MIN_BURST)) if global_rate else None
+        self.connections = {}
+        self.ip_buckets = {}
+        self.queue = []
+        self.sequence = itertools.count()
+        self.virtual_time = 0.0
+        self.dispatcher = None
+
+    def open(self, request: web.Request) -> Optional[Stream]:
+        """
+        Registers a new stream, None when its IP already has max_connections open.
+        """
+        ip = client_ip(request)
+        if self.max_connections and self.connections.get(ip, 0) >= self.max_connections:
+            SHAPER_REJECTIONS.inc(reason="connections")
+            return None
+        self.connections[ip] = self.connections.get(ip, 0) + 1
+        if self.ip_rate and ip not in self.ip_buckets:
+            self.ip_buckets[ip] = TokenBucket(self.ip_rate, max(self.ip_rate, MIN_BURST))
+        interactive = is_interactive(request)
+        return Stream(ip, interactive, self.interactive_weight if interactive else 1)
+
+    def close(self, stream: Stream):
+        self.connections[stream.ip] -= 1
+        if not self.connections[stream.ip]:
+            del self.connections[stream.ip]
+            self.ip_buckets.pop(stream.ip, None)
+
+    async def throttle(self, stream: Stream, size: int):
+        """
+        Waits until `size` bytes of `stream` may be sent.
+        """
+        ip_bucket = self.ip_buckets.get(stream.ip)
+        if ip_bucket is not None:
+            if ip_bucket.delay(size):
+                SHAPER_DELAYED_BYTES.inc(size, priority=stream.priority)
+            await ip_bucket.acquire(size)
+        if self.bucket is None:
+            return
+
+        stream.finish = max(self.virtual_time, stream.finish) + size / stream.weight
+        if not self.queue and self.bucket.try_acquire(size):
+            self.virtual_time = stream.finish
+            return
+        SHAPER_DELAYED_BYTES.inc(size, priority=stream.priority)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (stream.finish, next(self.sequence), size, future))
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        await future
+
+    async def dispatch(self):
+        """
+        Releases the queued chunks, smallest virtual finish time first, as the global bucket refills.
+        """
+        while self.queue:
+            finish, _, size, future = self.queue[0]
+            if future.done():
+                heapq.heappop(self.queue)
+                continue
+            delay = self.bucket.delay(size)
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self.queue)
+            self.bucket.tokens -= size
+            self.virtual_time = finish
+            future.set_result(None)
+
+    def snapshot(self) -> dict:
+        return {
+            "ips": len(self.connections),
+            "streams": sum(self.connections.values()),
+            "queued_chunks": len(self.queue),
+        }
+
+
+shaper = Shaper(Server.MAX_CONNECTIONS_PER_IP, Server.IP_RATE_LIMIT, Server.GLOBAL_RATE_LIMIT, Server.INTERACTIVE_WEIGHT)
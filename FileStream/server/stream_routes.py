@@ -1,18 +1,77 @@
 import time
-import math
+import asyncio
+import secrets
 import logging
 import mimetypes
+import urllib.parse
 import traceback
 from aiohttp import web
 from aiohttp.http_exceptions import BadStatusLine
 from FileStream.bot import multi_clients, work_loads, FileStream
+from FileStream.bot.scheduler import scheduler
 from FileStream.config import Telegram, Server
-from FileStream.server.exceptions import FIleNotFound, InvalidHash
+from FileStream.server.exceptions import FIleNotFound, InvalidHash, RangeNotSatisfiable
+from FileStream.server.http_range import parse_range, plan_fetches, if_range_matches
+from FileStream.server.http_cache import file_etag, content_etag, http_date, cache_control, is_not_modified
+from FileStream.server.cluster import cluster
+from FileStream.server.shaping import shaper, Stream
+from FileStream.server.hls import render_playlist
 from FileStream import utils, StartTime, __version__
-from FileStream.utils.render_template import render_page
+from FileStream.utils import database
+from FileStream.utils.database import db
+from FileStream.utils.render_template import render_page, page_cache
+from FileStream.utils.chunk_cache import chunk_cache
+from FileStream.utils.cache import TTLCache
+from FileStream.utils.custom_dl import MAX_CHUNK_SIZE
+from FileStream.utils.container import UnsupportedContainer, IndexCache, RangeReader, mp4_segment_index, find_index
+from FileStream.utils.metrics import (
+    registry, Gauge, CallbackCounter, cache_counts, BYTES_SERVED, TIME_TO_FIRST_BYTE, HTTP_REQUESTS, HTTP_SECONDS
+)
 
 routes = web.RouteTableDef()
 
+class_cache = {}
+# Segment index, or the reason a file cannot be segmented, by file_unique_id
+segment_indexes = TTLCache(Server.FILE_CACHE_SIZE, Server.FILE_CACHE_TTL)
+# Head and container index of played media files by file_unique_id, the prefetches in flight
+# and the (start, end, future) of the region each of them is reading
+index_cache = IndexCache(Server.INDEX_CACHE_SIZE)
+index_prefetches = {}
+index_pending = {}
+
+registry.register(Gauge(
+    "filestream_active_streams", "Streams currently served by each client.", ("client",),
+    collect=lambda: {(index,): load for index, load in work_loads.items()},
+))
+registry.register(CallbackCounter(
+    "filestream_cache_requests_total", "Lookups of the in-process caches.", ("cache", "result"),
+    collect=cache_counts({"file_properties": utils.ByteStreamer.cached_file_ids, "chunks": chunk_cache, "pages": page_cache, "index": index_cache}),
+))
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    """
+    Counts requests per route and the time until the response headers are ready.
+    Streamed responses send their headers before the handler returns and record
+    that moment in request["headers_sent"], so the body's duration is not counted.
+    """
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    start = time.monotonic()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_REQUESTS.inc(route=route, method=request.method, status=status)
+        HTTP_SECONDS.observe(request.get("headers_sent", time.monotonic()) - start, route=route)
+
+
 @routes.get("/status", allow_head=True)
 async def root_route_handler(_):
     return web.json_response(
@@ -27,23 +86,38 @@ async def root_route_handler(_):
                     sorted(work_loads.items(), key=lambda x: x[1], reverse=True)
                 )
             ),
+            "clients": scheduler.snapshot(),
+            "cluster": cluster.snapshot() if cluster.enabled else None,
+            "shaper": shaper.snapshot(),
             "version": __version__,
         }
     )
 
+@routes.get("/metrics")
+async def metrics_handler(_):
+    return web.Response(
+        body=registry.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
 @routes.get("/watch/{path}", allow_head=True)
 async def watch_handler(request: web.Request):
     try:
         path = request.match_info["path"]
         html_content = await render_page(path)
-        return web.Response(text=html_content, content_type='text/html', headers={
+        headers = {
+            "ETag": content_etag(html_content),
+            "Cache-Control": Server.CACHE_CONTROL_WATCH,
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Methods": "GET, OPTIONS",
             "Access-Control-Allow-Headers": "Range, Content-Type, Accept",
-        })
+        }
+        if is_not_modified(request, headers["ETag"]):
+            return web.Response(status=304, headers=headers)
+        return web.Response(text=html_content, content_type='text/html', headers=headers)
     except InvalidHash as e:
         raise web.HTTPForbidden(text=e.message)
-    except FIleNotFound as e:
+    except (FIleNotFound, database.FIleNotFound) as e:
         raise web.HTTPNotFound(text=e.message)
     except (AttributeError, BadStatusLine, ConnectionResetError):
         pass
@@ -52,10 +126,12 @@ async def watch_handler(request: web.Request):
 async def stream_handler(request: web.Request):
     try:
         path = request.match_info["path"]
+        if request.method == "HEAD":
+            return await media_head(request, path)
         return await media_streamer(request, path)
     except InvalidHash as e:
         raise web.HTTPForbidden(text=e.message)
-    except FIleNotFound as e:
+    except (FIleNotFound, database.FIleNotFound) as e:
         raise web.HTTPNotFound(text=e.message)
     except (AttributeError, BadStatusLine, ConnectionResetError):
         pass
@@ -65,14 +141,54 @@ async def stream_handler(request: web.Request):
         logging.debug(traceback.format_exc())
         raise web.HTTPInternalServerError(text=str(e))
 
-class_cache = {}
+@routes.get("/hls/{path}/", allow_head=True)
+@routes.get("/hls/{path}/index.m3u8", allow_head=True)
+async def hls_handler(request: web.Request):
+    try:
+        db_id = request.match_info["path"]
+        index, tg_connect = get_streamer(request, db_id)
+        file_id = await tg_connect.get_file_properties(db_id, multi_clients)
 
-async def media_streamer(request: web.Request, db_id: str):
-    range_header = request.headers.get("Range")
-    
-    index = min(work_loads, key=work_loads.get)
+        segment_index = segment_indexes.get(file_id.unique_id)
+        if segment_index is None:
+            try:
+                segment_index = await mp4_segment_index(
+                    lambda offset, length: read_range(tg_connect, file_id, index, offset, length), file_id.file_size
+                )
+            except UnsupportedContainer as e:
+                segment_index = e
+            segment_indexes.set(file_id.unique_id, segment_index)
+        if isinstance(segment_index, UnsupportedContainer):
+            raise web.HTTPUnsupportedMediaType(text=segment_index.message)
+
+        playlist = render_playlist(segment_index, urllib.parse.urljoin(Server.URL, f"dl/{db_id}"))
+        headers = {
+            "Content-Type": "application/vnd.apple.mpegurl",
+            "ETag": content_etag(playlist),
+            "Cache-Control": cache_control(file_id.mime_type),
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "GET, OPTIONS",
+            "Access-Control-Allow-Headers": "Range, Content-Type, Accept",
+        }
+        if is_not_modified(request, headers["ETag"]):
+            del headers["Content-Type"]
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=playlist.encode(), headers=headers)
+    except InvalidHash as e:
+        raise web.HTTPForbidden(text=e.message)
+    except (FIleNotFound, database.FIleNotFound) as e:
+        raise web.HTTPNotFound(text=e.message)
+    except (AttributeError, BadStatusLine, ConnectionResetError):
+        pass
+
+
+def get_streamer(request: web.Request, db_id: str):
+    """
+    Picks the client for a file and returns its index and ByteStreamer.
+    """
+    index = scheduler.pick(key=db_id)
     faster_client = multi_clients[index]
-    
+
     if Telegram.MULTI_CLIENT:
         logging.info(f"Client {index} is now serving {request.headers.get('X-FORWARDED-FOR',request.remote)}")
 
@@ -83,43 +199,118 @@ async def media_streamer(request: web.Request, db_id: str):
         logging.debug(f"Creating new ByteStreamer object for client {index}")
         tg_connect = utils.ByteStreamer(faster_client)
         class_cache[faster_client] = tg_connect
+    return index, tg_connect
+
+
+async def media_streamer(request: web.Request, db_id: str):
+    start = time.monotonic()
+    # A request already redirected by a peer is served here, whatever this node's view is
+    if "hop" not in request.query:
+        peer = cluster.redirect_target(db_id)
+        if peer is not None:
+            query = dict(request.query, hop=cluster.node_id)
+            logging.debug(f"Redirecting {db_id} to node {peer['_id']}")
+            return web.Response(status=307, headers={
+                "Location": cluster.redirect_url(peer, request.path, urllib.parse.urlencode(query)),
+                "Access-Control-Allow-Origin": "*",
+            })
+    cluster.touch(db_id)
+
+    stream = shaper.open(request)
+    if stream is None:
+        return web.Response(status=429, text="429: Too many streams from this address", headers={
+            "Retry-After": "5",
+            "Access-Control-Allow-Origin": "*",
+        })
+    try:
+        return await serve_media(request, db_id, stream, start)
+    finally:
+        shaper.close(stream)
+
+
+async def serve_media(request: web.Request, db_id: str, stream: Stream, start: float):
+    index, tg_connect = get_streamer(request, db_id)
 
     logging.debug("before calling get_file_properties")
     file_id = await tg_connect.get_file_properties(db_id, multi_clients)
     logging.debug("after calling get_file_properties")
-    
-    file_size = file_id.file_size
 
-    if range_header:
-        from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
-        from_bytes = int(from_bytes)
-        until_bytes = int(until_bytes) if until_bytes else file_size - 1
+    prepared = prepare_response(
+        request, file_id.file_size, file_id.unique_id, file_id.mime_type, utils.get_name(file_id), getattr(file_id, "time", None)
+    )
+    if isinstance(prepared, web.Response):
+        return prepared
+    status_code, headers, ranges, part_headers, closing = prepared
+
+    if ranges is not None and len(ranges) == 1:
+        data = await pinned_range(file_id, *ranges[0])
+        if data is not None:
+            TIME_TO_FIRST_BYTE.observe(time.monotonic() - start, route="/dl/{path}")
+            await shaper.throttle(stream, len(data))
+            BYTES_SERVED.inc(len(data), client=index)
+            return web.Response(status=status_code, body=data, headers=headers)
+    prefetch_index(tg_connect, file_id, index)
+
+    if ranges is None and not file_id.file_size:
+        return web.Response(status=status_code, body=b"", headers=headers)
+    if ranges is None:
+        body = stream_range(tg_connect, file_id, index, 0, file_id.file_size - 1)
+    elif len(ranges) == 1:
+        body = stream_range(tg_connect, file_id, index, *ranges[0])
     else:
-        from_bytes = 0
-        until_bytes = file_size - 1
+        body = multipart_body(tg_connect, file_id, index, ranges, part_headers, closing)
 
-    if (until_bytes >= file_size) or (from_bytes < 0) or (until_bytes < from_bytes):
-        return web.Response(
-            status=416,
-            body="416: Range not satisfiable",
-            headers={"Content-Range": f"bytes */{file_size}"},
-        )
+    # Chunks are written as they come, write() waits for the transport to drain
+    response = web.StreamResponse(status=status_code, headers=headers)
+    await response.prepare(request)
+    request["headers_sent"] = time.monotonic()
+    first = True
+    try:
+        async for chunk in body:
+            if first:
+                TIME_TO_FIRST_BYTE.observe(time.monotonic() - start, route="/dl/{path}")
+                first = False
+            await shaper.throttle(stream, len(chunk))
+            await response.write(chunk)
+            BYTES_SERVED.inc(len(chunk), client=index)
+        await response.write_eof()
+    except ConnectionResetError:
+        logging.debug(f"Client disconnected while streaming {db_id}")
+    finally:
+        await body.aclose()
+    return response
 
-    chunk_size = 1024 * 1024
-    until_bytes = min(until_bytes, file_size - 1)
 
-    offset = from_bytes - (from_bytes % chunk_size)
-    first_part_cut = from_bytes - offset
-    last_part_cut = until_bytes % chunk_size + 1
+async def media_head(request: web.Request, db_id: str):
+    """
+    Answers a HEAD from the file-properties cache or the database record,
+    without picking a client or opening a Telegram stream.
+    """
+    for client in multi_clients.values():
+        file_id = utils.ByteStreamer.cached_file_ids.peek((client.id, db_id))
+        if file_id is not None:
+            metadata = (file_id.file_size, file_id.unique_id, file_id.mime_type, utils.get_name(file_id), getattr(file_id, "time", None))
+            break
+    else:
+        file_info = await db.get_file(db_id)
+        metadata = (file_info["file_size"], file_info["file_unique_id"], file_info.get("mime_type"), file_info["file_name"], file_info.get("time"))
 
-    req_length = until_bytes - from_bytes + 1
-    part_count = math.ceil(until_bytes / chunk_size) - math.floor(offset / chunk_size)
-    body = tg_connect.yield_file(
-        file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size
-    )
+    prepared = prepare_response(request, *metadata)
+    if isinstance(prepared, web.Response):
+        return prepared
+    status_code, headers, *_ = prepared
+    return web.Response(status=status_code, headers=headers)
+
+
+def prepare_response(request: web.Request, file_size: int, unique_id: str, mime_type: str, file_name: str, upload_time: float):
+    """
+    Evaluates the conditional and Range headers of a /dl request from the file metadata alone.
+    Returns a finished response for 304 and 416, otherwise the status, headers, ranges and,
+    for multipart responses, the part headers and closing delimiter.
+    """
+    etag = file_etag(unique_id, file_size)
+    last_modified = http_date(upload_time)
 
-    mime_type = file_id.mime_type
-    file_name = utils.get_name(file_id)
     disposition = "inline" if mime_type and (mime_type.startswith("video/") or mime_type.startswith("audio/")) else "attachment"
 
     if not mime_type:
@@ -127,19 +318,203 @@ async def media_streamer(request: web.Request, db_id: str):
 
     headers = {
         "Content-Type": mime_type,
-        "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-        "Content-Length": str(req_length),
         "Content-Disposition": f'{disposition}; filename="{file_name}"',
         "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Cache-Control": cache_control(mime_type),
         "Access-Control-Allow-Origin": "*",  # Permite CORS para reproducción en navegadores
         "Access-Control-Allow-Methods": "GET, OPTIONS",
         "Access-Control-Allow-Headers": "Range, Content-Type, Accept",
     }
+    if last_modified:
+        headers["Last-Modified"] = last_modified
 
-    status_code = 206 if range_header else 200
+    # Conditionals are evaluated before Range (RFC 9110 section 13.2.2)
+    if is_not_modified(request, etag, last_modified):
+        del headers["Content-Type"]
+        return web.Response(status=304, headers=headers)
 
-    return web.Response(
-        status=status_code,
-        body=body,
-        headers=headers,
+    range_header = request.headers.get("Range")
+    if not if_range_matches(request.headers.get("If-Range"), etag, last_modified):
+        range_header = None
+    try:
+        ranges = parse_range(range_header, file_size)
+    except RangeNotSatisfiable:
+        return web.Response(
+            status=416,
+            body="416: Range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"},
+        )
+
+    part_headers, closing = None, None
+    if ranges is None:
+        status_code = 200
+        headers["Content-Length"] = str(file_size)
+    elif len(ranges) == 1:
+        status_code = 206
+        from_bytes, until_bytes = ranges[0]
+        headers["Content-Range"] = f"bytes {from_bytes}-{until_bytes}/{file_size}"
+        headers["Content-Length"] = str(until_bytes - from_bytes + 1)
+    else:
+        status_code = 206
+        boundary = secrets.token_hex(16)
+        part_headers = [
+            (
+                f"--{boundary}\r\n"
+                f"Content-Type: {mime_type}\r\n"
+                f"Content-Range: bytes {from_bytes}-{until_bytes}/{file_size}\r\n\r\n"
+            ).encode()
+            for from_bytes, until_bytes in ranges
+        ]
+        closing = f"--{boundary}--\r\n".encode()
+        headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        headers["Content-Length"] = str(
+            sum(len(part) + until_bytes - from_bytes + 1 + 2 for part, (from_bytes, until_bytes) in zip(part_headers, ranges))
+            + len(closing)
+        )
+    return status_code, headers, ranges, part_headers, closing
+
+
+def prefetch_index(tg_connect: utils.ByteStreamer, file_id, index: int):
+    """
+    On the first request for a video or audio file, reads its head and container
+    index in the background and pins them, so the probes a player sends before
+    it can start (moov at the end of an MP4, Cues of a Matroska file) are
+    answered from memory instead of each opening a Telegram stream.
+    """
+    unique_id = file_id.unique_id
+    if (
+        not Server.INDEX_CACHE_SIZE
+        or unique_id in index_cache
+        or unique_id in index_prefetches
+        or not file_id.mime_type
+        or not file_id.mime_type.startswith(("video/", "audio/"))
+    ):
+        return
+
+    async def read_region(start: int, end: int) -> bytes:
+        # Published before reading, so that probes inside the region wait for it and others do not
+        done = asyncio.get_running_loop().create_future()
+        index_pending[unique_id] = (start, end, done)
+        try:
+            if end - start < reader.block:
+                return await reader.read(start, end - start + 1)
+            # Large regions are streamed with full-size chunks and read-ahead, not block by block
+            return await read_range(tg_connect, file_id, index, start, end - start + 1)
+        finally:
+            done.set_result(None)
+
+    async def prefetch():
+        try:
+            head = await read_region(0, min(reader.block, file_id.file_size) - 1)
+            index_cache.put(unique_id, [(0, head)])
+            region = await find_index(reader)
+            if region is not None:
+                start, end = region
+                if start <= len(head):
+                    regions = [(0, await read_region(0, end))]
+                else:
+                    regions = [(0, head), (start, await read_region(start, end))]
+                index_cache.put(unique_id, regions)
+            logging.debug(f"Pinned {sum(len(data) for _, data in index_cache.entries.get(unique_id, ()))} index bytes of {unique_id}")
+        except Exception:
+            logging.debug(f"Index prefetch of {unique_id} failed", exc_info=True)
+        finally:
+            index_prefetches.pop(unique_id, None)
+            index_pending.pop(unique_id, None)
+
+    reader = RangeReader(
+        lambda offset, length: read_range(tg_connect, file_id, index, offset, length), file_id.file_size
     )
+    index_prefetches[unique_id] = asyncio.create_task(prefetch())
+
+
+async def pinned_range(file_id, from_bytes: int, until_bytes: int):
+    """
+    Bytes from_bytes..until_bytes (inclusive) from the pinned regions of the file, or None.
+    A range inside the region a prefetch is reading right now waits for that read,
+    which is already fetching the same bytes. Other ranges, e.g. seeks into the
+    middle of the file, never wait.
+    """
+    data = index_cache.get(file_id.unique_id, from_bytes, until_bytes)
+    pending = index_pending.get(file_id.unique_id)
+    if data is None and pending is not None:
+        start, end, done = pending
+        if start <= from_bytes and until_bytes <= end:
+            await asyncio.shield(done)
+            data = index_cache.get(file_id.unique_id, from_bytes, until_bytes)
+    return data
+
+
+def stream_range(tg_connect: utils.ByteStreamer, file_id, index: int, from_bytes: int, until_bytes: int):
+    """
+    Returns a generator of the bytes from_bytes..until_bytes (inclusive) of the file.
+    GetFile chunks never cross a 1 MiB boundary, so a short range that does is read
+    as two parts with their own small chunk size instead of two full 1 MiB chunks.
+    """
+    boundary = until_bytes - until_bytes % MAX_CHUNK_SIZE
+    if from_bytes < boundary and until_bytes - from_bytes < MAX_CHUNK_SIZE:
+        return chain_parts(
+            stream_part(tg_connect, file_id, index, from_bytes, boundary - 1),
+            stream_part(tg_connect, file_id, index, boundary, until_bytes),
+        )
+    return stream_part(tg_connect, file_id, index, from_bytes, until_bytes)
+
+
+async def chain_parts(*parts):
+    try:
+        for part in parts:
+            async for chunk in part:
+                yield chunk
+    finally:
+        for part in parts:
+            await part.aclose()
+
+
+def stream_part(tg_connect: utils.ByteStreamer, file_id, index: int, from_bytes: int, until_bytes: int):
+    chunk_size = utils.get_chunk_size(from_bytes, until_bytes)
+
+    offset = from_bytes - (from_bytes % chunk_size)
+    first_part_cut = from_bytes - offset
+    last_part_cut = until_bytes % chunk_size + 1
+
+    part_count = until_bytes // chunk_size - offset // chunk_size + 1
+    return tg_connect.yield_file(
+        file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size
+    )
+
+
+async def read_range(tg_connect: utils.ByteStreamer, file_id, index: int, offset: int, length: int) -> bytes:
+    """
+    Reads `length` bytes at `offset` of the file into memory, for container headers.
+    """
+    until_bytes = min(offset + length, file_id.file_size) - 1
+    if until_bytes < offset:
+        return b""
+    return b"".join([chunk async for chunk in stream_range(tg_connect, file_id, index, offset, until_bytes)])
+
+
+async def multipart_body(tg_connect: utils.ByteStreamer, file_id, index: int, ranges, part_headers, closing: bytes):
+    """
+    Yields a multipart/byteranges body. Ranges close to each other are read from
+    Telegram as one span and the gaps between them are skipped.
+    """
+    parts = iter(zip(ranges, part_headers))
+    for span_start, span_end, _ in plan_fetches(ranges):
+        (part_start, part_end), part_header = next(parts)
+        yield part_header
+        position = span_start
+        async for chunk in stream_range(tg_connect, file_id, index, span_start, span_end):
+            chunk_start, position = position, position + len(chunk)
+            while True:
+                start, end = max(part_start, chunk_start), min(part_end + 1, position)
+                if start < end:
+                    yield chunk[start - chunk_start:end - chunk_start]
+                if part_end >= position:
+                    break
+                yield b"\r\n"
+                if part_end == span_end:
+                    break
+                (part_start, part_end), part_header = next(parts)
+                yield part_header
+    yield closing
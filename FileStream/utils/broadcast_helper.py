@@ -1,19 +1,196 @@
+import os
+import time
+import string
+import random
 import asyncio
+import logging
+import datetime
 import traceback
+import aiofiles
+from pyrogram import Client
 from pyrogram.errors import FloodWait, InputUserDeactivated, UserIsBlocked, PeerIdInvalid
+from FileStream.config import Telegram, Server
+from FileStream.utils.database import db
+from FileStream.utils.rate_limit import TokenBucket
 
-async def send_msg(user_id, message):
-    try:
-        await message.copy(chat_id=user_id)
-        return 200, None
-    except FloodWait as e:
-        await asyncio.sleep(e.value)
-        return send_msg(user_id, message)
-    except InputUserDeactivated:
-        return 400, f"{user_id} : deactivated\n"
-    except UserIsBlocked:
-        return 400, f"{user_id} : blocked the bot\n"
-    except PeerIdInvalid:
-        return 400, f"{user_id} : user id invalid\n"
-    except Exception as e:
-        return 500, f"{user_id} : {traceback.format_exc()}\n"
+# Running broadcasts by id
+broadcast_ids = {}
+# Shared by every broadcast of the process, so concurrent ones never add up past Telegram's limit
+limiter = TokenBucket(Telegram.BROADCAST_RATE)
+# Seconds without a checkpoint after which another process may take over a broadcast
+CLAIM_TTL = 600
+
+
+async def send_msg(user_id, message, limiter: TokenBucket = None):
+    while True:
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            await message.copy(chat_id=user_id)
+            return 200, None
+        except FloodWait as e:
+            # Stop every worker sharing the limiter, then retry this user
+            if limiter is not None:
+                limiter.pause(e.value)
+            await asyncio.sleep(e.value)
+        except InputUserDeactivated:
+            return 400, f"{user_id} : deactivated\n"
+        except UserIsBlocked:
+            return 400, f"{user_id} : blocked the bot\n"
+        except PeerIdInvalid:
+            return 400, f"{user_id} : user id invalid\n"
+        except Exception as e:
+            return 500, f"{user_id} : {traceback.format_exc()}\n"
+
+
+def new_broadcast_id() -> str:
+    while True:
+        broadcast_id = ''.join([random.choice(string.ascii_letters) for i in range(3)])
+        if not broadcast_ids.get(broadcast_id):
+            return broadcast_id
+
+
+class Broadcast:
+    """
+    Copies a message to every user with a pool of workers sharing a token bucket
+    matched to Telegram's send limits. Users are walked in id order in batches,
+    invalid users of each batch are deleted at once and the position is saved to
+    the database after every batch, so an interrupted broadcast resumes where it
+    stopped. The status message is edited on an interval, not after every user.
+    """
+
+    def __init__(self, client: Client, state: dict):
+        self.client = client
+        self.state = state
+        self.log_path = f"broadcast_{state['_id']}.txt"
+        self.workers = asyncio.Semaphore(Telegram.BROADCAST_WORKERS)
+        self.cancelled = False
+        self.task = None
+
+    @classmethod
+    async def create(cls, client: Client, command, message, status_message) -> "Broadcast":
+        state = {
+            "_id": new_broadcast_id(),
+            "chat_id": command.chat.id,
+            "command_id": command.id,
+            "message_chat_id": message.chat.id,
+            "message_id": message.id,
+            "status_id": status_message.id,
+            "total": await db.total_users_count(),
+            "after": None,
+            "done": 0,
+            "success": 0,
+            "failed": 0,
+            "start_time": time.time(),
+            "owner": Server.NODE_ID,
+            "claimed": time.time(),
+        }
+        await db.save_broadcast(state)
+        return cls(client, state)
+
+    def start(self):
+        broadcast_ids[self.state["_id"]] = self
+        self.task = asyncio.create_task(self.run())
+
+    def cancel(self):
+        self.cancelled = True
+
+    async def run(self):
+        state = self.state
+        try:
+            message = await self.client.get_messages(state["message_chat_id"], state["message_id"])
+            progress = asyncio.create_task(self.report_progress())
+            try:
+                batch = []
+                async for user in await db.get_all_users(after=state["after"]):
+                    batch.append(int(user["id"]))
+                    if len(batch) >= Telegram.BROADCAST_BATCH:
+                        await self.send_batch(message, batch)
+                        batch = []
+                    if self.cancelled:
+                        break
+                if batch and not self.cancelled:
+                    await self.send_batch(message, batch)
+            finally:
+                progress.cancel()
+            await self.finish()
+        except Exception:
+            logging.error(f"Broadcast {state['_id']} stopped, it will resume on restart", exc_info=True)
+        finally:
+            broadcast_ids.pop(state["_id"], None)
+
+    async def send_batch(self, message, user_ids: list):
+        async def send(user_id):
+            async with self.workers:
+                return await send_msg(user_id, message, limiter)
+
+        results = await asyncio.gather(*[send(user_id) for user_id in user_ids])
+
+        invalid = [user_id for user_id, (sts, _) in zip(user_ids, results) if sts == 400]
+        await db.delete_users(invalid)
+        errors = "".join(msg for _, msg in results if msg is not None)
+        if errors:
+            async with aiofiles.open(self.log_path, "a") as broadcast_log_file:
+                await broadcast_log_file.write(errors)
+
+        state = self.state
+        success = sum(1 for sts, _ in results if sts == 200)
+        state["success"] += success
+        state["failed"] += len(results) - success
+        state["done"] += len(results)
+        state["after"] = user_ids[-1]
+        state["claimed"] = time.time()
+        await db.save_broadcast(state)
+
+    def status_text(self) -> str:
+        state = self.state
+        return f"Broadcast `{state['_id']}` Status\n\ncurrent: {state['done']}/{state['total']}\nfailed:{state['failed']}\nsuccess: {state['success']}"
+
+    async def report_progress(self):
+        last = None
+        while True:
+            await asyncio.sleep(Telegram.BROADCAST_PROGRESS_INTERVAL)
+            text = self.status_text()
+            if text == last:
+                continue
+            try:
+                await self.client.edit_message_text(self.state["chat_id"], self.state["status_id"], text)
+                last = text
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+            except Exception:
+                pass
+
+    async def finish(self):
+        state = self.state
+        await db.delete_broadcast(state["_id"])
+        completed_in = datetime.timedelta(seconds=int(time.time() - state["start_time"]))
+        try:
+            await self.client.delete_messages(state["chat_id"], state["status_id"])
+        except Exception:
+            pass
+        text = (
+            f"broadcast {'cancelled' if self.cancelled else 'completed'} in `{completed_in}`\n\n"
+            f"Total users {state['total']}.\nTotal done {state['done']}, {state['success']} success and {state['failed']} failed."
+        )
+        if os.path.exists(self.log_path):
+            await self.client.send_document(
+                state["chat_id"], document=self.log_path, caption=text, reply_to_message_id=state["command_id"]
+            )
+            os.remove(self.log_path)
+        else:
+            await self.client.send_message(state["chat_id"], text, reply_to_message_id=state["command_id"])
+
+
+async def resume_broadcasts(client: Client):
+    """
+    Restarts the broadcasts that were running when the bot stopped. Each one is
+    claimed in the database first, so that with several processes sharing the
+    database only one of them resumes it.
+    """
+    for state in await db.get_broadcasts():
+        state = await db.claim_broadcast(state["_id"], Server.NODE_ID, time.time() - CLAIM_TTL)
+        if state is None or state["_id"] in broadcast_ids:
+            continue
+        logging.info(f"Resuming broadcast {state['_id']} after user {state['after']}")
+        Broadcast(client, state).start()
@@ -0,0 +1,104 @@
+import os
+import logging
+import aiofiles
+import aiofiles.os
+from collections import OrderedDict
+from typing import Optional
+from FileStream.config import Server
+
+
+class ChunkCache:
+    """
+    On-disk store of media chunks keyed by file_unique_id and chunk offset.
+    Every chunk lives in its own file under <path>/<file_unique_id>/ and the
+    least recently used chunks are evicted once the byte budget is exceeded.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        if self.enabled:
+            os.makedirs(self.path, exist_ok=True)
+            self.load_index()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def chunk_path(self, unique_id: str, offset: int, chunk_size: int) -> str:
+        return os.path.join(self.path, unique_id, f"{offset}.{chunk_size}")
+
+    def load_index(self):
+        """
+        Rebuilds the LRU index from the chunks left on disk, oldest first.
+        """
+        found = []
+        for media in os.scandir(self.path):
+            if not media.is_dir():
+                continue
+            for chunk in os.scandir(media.path):
+                if chunk.name.endswith(".tmp"):
+                    os.remove(chunk.path)
+                    continue
+                stat = chunk.stat()
+                found.append((stat.st_mtime, chunk.path, stat.st_size))
+        for _, path, size in sorted(found):
+            self.entries[path] = size
+            self.size += size
+        logging.info(f"[ChunkCache] Loaded {len(self.entries)} chunks ({self.size} bytes) from {self.path}")
+        self.evict()
+
+    async def get(self, unique_id: str, offset: int, chunk_size: int) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        path = self.chunk_path(unique_id, offset, chunk_size)
+        if path not in self.entries:
+            self.misses += 1
+            return None
+        try:
+            async with aiofiles.open(path, "rb") as f:
+                data = await f.read()
+        except FileNotFoundError:
+            self.size -= self.entries.pop(path, 0)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(path)
+        self.hits += 1
+        return data
+
+    async def put(self, unique_id: str, offset: int, chunk_size: int, data: bytes):
+        if not self.enabled or not data or len(data) > self.max_bytes:
+            return
+        path = self.chunk_path(unique_id, offset, chunk_size)
+        if path in self.entries:
+            return
+        tmp_path = f"{path}.{id(data)}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(data)
+            await aiofiles.os.replace(tmp_path, path)
+        except OSError:
+            logging.warning(f"[ChunkCache] Could not store chunk {path}", exc_info=True)
+            return
+        if path in self.entries:
+            return
+        self.entries[path] = len(data)
+        self.size += len(data)
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            path, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+chunk_cache = ChunkCache(Server.CHUNK_CACHE_DIR, Server.CHUNK_CACHE_SIZE)
@@ -0,0 +1,344 @@
+import struct
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Reads `length` bytes at `offset` of a file, shorter only at the end of the file
+ReadFunc = Callable[[int, int], Awaitable[bytes]]
+
+# Container headers are read in blocks of this size
+READ_BLOCK = 64 * 1024
+# Top-level MP4 boxes walked before giving up on finding the index
+MAX_TOP_LEVEL_BOXES = 64
+
+
+class UnsupportedContainer(Exception):
+    message = "Unsupported container"
+
+    def __init__(self, message: str = None):
+        super().__init__(message or self.message)
+        if message:
+            self.message = message
+
+
+class RangeReader:
+    """
+    Buffers block-aligned reads of a remote file so that walking small headers
+    costs one upstream read per READ_BLOCK instead of one per header.
+    """
+
+    def __init__(self, read: ReadFunc, file_size: int, block: int = READ_BLOCK):
+        self.read_upstream = read
+        self.file_size = file_size
+        self.block = block
+        self.blocks: Dict[int, bytes] = {}
+
+    async def read(self, offset: int, length: int) -> bytes:
+        end = min(offset + length, self.file_size)
+        parts = []
+        position = offset
+        while position < end:
+            block_offset = position - position % self.block
+            if block_offset not in self.blocks:
+                self.blocks[block_offset] = await self.read_upstream(
+                    block_offset, min(self.block, self.file_size - block_offset)
+                )
+            data = self.blocks[block_offset]
+            if not data:
+                break
+            piece = data[position - block_offset:end - block_offset]
+            parts.append(piece)
+            position += len(piece)
+        return b"".join(parts)
+
+
+class Box:
+    def __init__(self, box_type: str, offset: int, size: int, header_size: int):
+        self.type = box_type
+        self.offset = offset
+        self.size = size
+        self.header_size = header_size
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.size
+
+    def __repr__(self):
+        return f"Box({self.type!r}, offset={self.offset}, size={self.size})"
+
+
+async def read_box(reader: RangeReader, offset: int) -> Optional[Box]:
+    """
+    Reads the MP4 box header at `offset`, None past the end of the file.
+    """
+    header = await reader.read(offset, 16)
+    if len(header) < 8:
+        return None
+    size, box_type = struct.unpack(">I4s", header[:8])
+    header_size = 8
+    if size == 1:
+        if len(header) < 16:
+            return None
+        size = struct.unpack(">Q", header[8:16])[0]
+        header_size = 16
+    elif size == 0:
+        size = reader.file_size - offset
+    if size < header_size:
+        raise UnsupportedContainer("Malformed MP4 box")
+    return Box(box_type.decode("latin-1"), offset, size, header_size)
+
+
+async def top_level_boxes(reader: RangeReader, stop: Tuple[str, ...] = ()) -> List[Box]:
+    """
+    Walks the top-level MP4 boxes from the start of the file, up to and including
+    the first box whose type is in `stop`.
+    """
+    boxes = []
+    offset = 0
+    while offset < reader.file_size and len(boxes) < MAX_TOP_LEVEL_BOXES:
+        box = await read_box(reader, offset)
+        if box is None:
+            break
+        boxes.append(box)
+        if box.type in stop:
+            break
+        offset = box.end
+    if not boxes or boxes[0].type not in ("ftyp", "styp"):
+        raise UnsupportedContainer("Not an MP4 file")
+    return boxes
+
+
+def parse_sidx(data: bytes) -> Tuple[int, int, List[Tuple[int, int, int]]]:
+    """
+    Parses the body of a sidx box (after the box header).
+    Returns the timescale, first_offset and (reference_type, referenced_size, subsegment_duration) per reference.
+    """
+    version = data[0]
+    timescale = struct.unpack(">I", data[8:12])[0]
+    if version == 0:
+        _, first_offset = struct.unpack(">II", data[12:20])
+        position = 20
+    else:
+        _, first_offset = struct.unpack(">QQ", data[12:28])
+        position = 28
+    reference_count = struct.unpack(">H", data[position + 2:position + 4])[0]
+    position += 4
+    references = []
+    for _ in range(reference_count):
+        reference, duration, _ = struct.unpack(">III", data[position:position + 12])
+        references.append((reference >> 31, reference & 0x7FFFFFFF, duration))
+        position += 12
+    return timescale, first_offset, references
+
+
+class SegmentIndex:
+    """
+    Byte layout of a fragmented MP4: the initialization section (ftyp + moov)
+    and, per media segment, its (offset, size, duration in seconds).
+    """
+
+    def __init__(self, init_size: int, segments: List[Tuple[int, int, float]]):
+        self.init_size = init_size
+        self.segments = segments
+
+    @property
+    def duration(self) -> float:
+        return sum(duration for _, _, duration in self.segments)
+
+
+async def mp4_segment_index(read: ReadFunc, file_size: int) -> SegmentIndex:
+    """
+    Builds the SegmentIndex of a fragmented MP4 from its moov and sidx boxes,
+    reading only the first few KiB of the file in the usual layout.
+    Progressive MP4s and files without a sidx cannot be split into byte ranges
+    that play on their own and raise UnsupportedContainer.
+    """
+    reader = RangeReader(read, file_size)
+    boxes = await top_level_boxes(reader, stop=("sidx", "moof", "mdat"))
+    types = [box.type for box in boxes]
+    if "moov" not in types:
+        raise UnsupportedContainer("MP4 without a moov box before its media")
+    if types[-1] != "sidx":
+        raise UnsupportedContainer("Only fragmented MP4 files with a sidx index can be segmented")
+
+    moov = boxes[types.index("moov")]
+    sidx = boxes[-1]
+    body = await reader.read(sidx.offset + sidx.header_size, sidx.size - sidx.header_size)
+    try:
+        timescale, first_offset, references = parse_sidx(body)
+    except (IndexError, struct.error):
+        raise UnsupportedContainer("Truncated or malformed sidx box")
+    if not timescale or any(reference_type for reference_type, _, _ in references):
+        raise UnsupportedContainer("Hierarchical sidx indexes are not supported")
+
+    segments = []
+    offset = sidx.end + first_offset
+    for _, size, duration in references:
+        segments.append((offset, size, duration / timescale))
+        offset += size
+    if offset > file_size:
+        raise UnsupportedContainer("sidx references past the end of the file")
+    return SegmentIndex(moov.end, segments)
+
+
+# Container indexes larger than this are not pinned in memory
+MAX_INDEX_REGION = 8 * 1024 * 1024
+
+MKV_EBML = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_SEEK_HEAD = 0x114D9B74
+MKV_SEEK = 0x4DBB
+MKV_SEEK_ID = 0x53AB
+MKV_SEEK_POSITION = 0x53AC
+MKV_CUES = 0x1C53BB6B
+MKV_CLUSTER = 0x1F43B675
+
+
+def read_vint(data: bytes, position: int, keep_marker: bool = False) -> Tuple[Optional[int], int]:
+    """
+    Reads an EBML variable length integer, returns (value, next position).
+    The value is None for the reserved "unknown size".
+    """
+    first = data[position]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8 or position + length > len(data):
+        raise UnsupportedContainer("Malformed EBML data")
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[position + 1:position + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = None
+    return value, position + length
+
+
+def read_element(data: bytes, position: int) -> Tuple[int, Optional[int], int]:
+    """
+    Reads an EBML element header, returns (id, data size, data position).
+    """
+    element_id, position = read_vint(data, position, keep_marker=True)
+    size, position = read_vint(data, position)
+    return element_id, size, position
+
+
+async def mp4_index_region(reader: RangeReader) -> Optional[Tuple[int, int]]:
+    """
+    Byte range of the moov box, wherever it is in the file.
+    """
+    boxes = await top_level_boxes(reader, stop=("moov",))
+    moov = boxes[-1]
+    if moov.type != "moov":
+        return None
+    return moov.offset, moov.end - 1
+
+
+async def mkv_index_region(reader: RangeReader) -> Optional[Tuple[int, int]]:
+    """
+    Byte range of the Cues element of a Matroska/WebM file, found through the SeekHead.
+    """
+    head = await reader.read(0, reader.block)
+    element_id, size, position = read_element(head, 0)
+    if element_id != MKV_EBML or size is None:
+        return None
+    element_id, _, segment_start = read_element(head, position + size)
+    if element_id != MKV_SEGMENT:
+        return None
+
+    position = segment_start
+    while position < len(head) - 12:
+        element_id, size, data_position = read_element(head, position)
+        if element_id == MKV_CLUSTER or size is None:
+            return None
+        if element_id == MKV_SEEK_HEAD:
+            break
+        position = data_position + size
+    else:
+        return None
+
+    seek_head = head[data_position:data_position + size]
+    position = 0
+    while position < len(seek_head):
+        element_id, size, data_position = read_element(seek_head, position)
+        if element_id == MKV_SEEK:
+            seek = seek_head[data_position:data_position + size]
+            seek_id = seek_position = None
+            child = 0
+            while child < len(seek):
+                child_id, child_size, child_position = read_element(seek, child)
+                value = seek[child_position:child_position + child_size]
+                if child_id == MKV_SEEK_ID:
+                    seek_id = int.from_bytes(value, "big")
+                elif child_id == MKV_SEEK_POSITION:
+                    seek_position = int.from_bytes(value, "big")
+                child = child_position + child_size
+            if seek_id == MKV_CUES and seek_position is not None:
+                cues_offset = segment_start + seek_position
+                cues_head = await reader.read(cues_offset, 12)
+                element_id, cues_size, cues_data = read_element(cues_head, 0)
+                if element_id != MKV_CUES or cues_size is None:
+                    return None
+                return cues_offset, cues_offset + cues_data + cues_size - 1
+        position = data_position + size
+    return None
+
+
+async def find_index(reader: RangeReader) -> Optional[Tuple[int, int]]:
+    """
+    Detects the container from the head of the file and returns the inclusive byte
+    range of its index, the MP4 moov or the Matroska Cues. None for other files and
+    for indexes larger than MAX_INDEX_REGION.
+    """
+    head = await reader.read(0, reader.block)
+    try:
+        if head[4:8] in (b"ftyp", b"styp"):
+            index = await mp4_index_region(reader)
+        elif head[:4] == MKV_EBML.to_bytes(4, "big"):
+            index = await mkv_index_region(reader)
+        else:
+            index = None
+    except (UnsupportedContainer, IndexError, struct.error):
+        index = None
+    if index is None or index[1] - index[0] >= MAX_INDEX_REGION or index[1] >= reader.file_size:
+        return None
+    return index
+
+
+class IndexCache:
+    """
+    Pins the index regions of recently played files in memory, keyed by
+    file_unique_id, within a byte budget. Least recently used files go first.
+    Only lookups for pinned files count as hits or misses.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries: "OrderedDict[str, List[Tuple[int, bytes]]]" = OrderedDict()
+
+    def __contains__(self, unique_id: str) -> bool:
+        return unique_id in self.entries
+
+    def put(self, unique_id: str, regions: List[Tuple[int, bytes]]):
+        if unique_id in self.entries:
+            self.size -= sum(len(data) for _, data in self.entries.pop(unique_id))
+        self.entries[unique_id] = regions
+        self.size += sum(len(data) for _, data in regions)
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= sum(len(data) for _, data in evicted)
+
+    def get(self, unique_id: str, from_bytes: int, until_bytes: int) -> Optional[bytes]:
+        """
+        Bytes from_bytes..until_bytes (inclusive) when a pinned region holds all of them.
+        """
+        if unique_id not in self.entries:
+            return None
+        for start, data in self.entries[unique_id]:
+            if start <= from_bytes and until_bytes < start + len(data):
+                self.entries.move_to_end(unique_id)
+                self.hits += 1
+                return data[from_bytes - start:until_bytes - start + 1]
+        self.misses += 1
+        return None
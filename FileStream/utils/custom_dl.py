@@ -1,20 +1,48 @@
+import time
 import asyncio
 import logging
-from typing import Dict, Union
+from collections import deque
+from typing import AsyncGenerator, Dict, Union
 from FileStream.bot import work_loads
+from FileStream.bot.scheduler import scheduler
+from FileStream.config import Server
 from pyrogram import Client, utils, raw
 from .file_properties import get_file_ids
-from pyrogram.session import Session, Auth
-from pyrogram.errors import AuthBytesInvalid
+from .chunk_cache import chunk_cache
+from .cache import TTLCache
+from .media_session import MediaSessionPool, get_media_pool
+from .metrics import GETFILE_SECONDS, GETFILE_ERRORS, FLOOD_WAITS
+from pyrogram.errors import FloodWait
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
 from pyrogram.types import Message
 
+# GetFile limits must be multiples of 4 KiB that divide 1 MiB
+MIN_CHUNK_SIZE = 4 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+
+def get_chunk_size(from_bytes: int, until_bytes: int) -> int:
+    """
+    Returns the smallest chunk size that serves the whole range with a single GetFile.
+    Powers of two between 4 KiB and 1 MiB keep every offset aligned, so small probes and
+    seeks fetch only a few KiB while long or open ranges use the maximum size and read-ahead.
+    """
+    chunk_size = MIN_CHUNK_SIZE
+    while chunk_size < MAX_CHUNK_SIZE and from_bytes // chunk_size != until_bytes // chunk_size:
+        chunk_size *= 2
+    return chunk_size
+
+
 class ByteStreamer:
+    # In-flight chunk fetches keyed by (media_id, offset, chunk_size), shared by every client
+    inflight_chunks: Dict[tuple, asyncio.Future] = {}
+    # Streams waiting on each in-flight fetch, the fetch is cancelled when the last one leaves
+    inflight_waiters: Dict[asyncio.Future, int] = {}
+    # File properties keyed by (client id, db_id), shared by every client
+    cached_file_ids = TTLCache(Server.FILE_CACHE_SIZE, Server.FILE_CACHE_TTL)
+
     def __init__(self, client: Client):
-        self.clean_timer = 30 * 60
         self.client: Client = client
-        self.cached_file_ids: Dict[str, FileId] = {}
-        asyncio.create_task(self.clean_cache())
 
     async def get_file_properties(self, db_id: str, multi_clients) -> FileId:
         """
@@ -22,11 +50,12 @@ class ByteStreamer:
         if the properties are cached, then it'll return the cached results.
         or it'll generate the properties from the Message ID and cache them.
         """
-        if not db_id in self.cached_file_ids:
+        file_id = self.cached_file_ids.get((self.client.id, db_id))
+        if file_id is None:
             logging.debug("Before Calling generate_file_properties")
-            await self.generate_file_properties(db_id, multi_clients)
+            file_id = await self.generate_file_properties(db_id, multi_clients)
             logging.debug(f"Cached file properties for file with ID {db_id}")
-        return self.cached_file_ids[db_id]
+        return file_id
     
     async def generate_file_properties(self, db_id: str, multi_clients) -> FileId:
         """
@@ -36,66 +65,9 @@ class ByteStreamer:
         logging.debug("Before calling get_file_ids")
         file_id = await get_file_ids(self.client, db_id, multi_clients, Message)
         logging.debug(f"Generated file ID and Unique ID for file with ID {db_id}")
-        self.cached_file_ids[db_id] = file_id
+        self.cached_file_ids.set((self.client.id, db_id), file_id)
         logging.debug(f"Cached media file with ID {db_id}")
-        return self.cached_file_ids[db_id]
-
-    async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
-        """
-        Generates the media session for the DC that contains the media file.
-        This is required for getting the bytes from Telegram servers.
-        """
-
-        media_session = client.media_sessions.get(file_id.dc_id, None)
-
-        if media_session is None:
-            if file_id.dc_id != await client.storage.dc_id():
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await Auth(
-                        client, file_id.dc_id, await client.storage.test_mode()
-                    ).create(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-
-                for _ in range(6):
-                    exported_auth = await client.invoke(
-                        raw.functions.auth.ExportAuthorization(dc_id=file_id.dc_id)
-                    )
-
-                    try:
-                        await media_session.invoke(
-                            raw.functions.auth.ImportAuthorization(
-                                id=exported_auth.id, bytes=exported_auth.bytes
-                            )
-                        )
-                        break
-                    except AuthBytesInvalid:
-                        logging.debug(
-                            f"Invalid authorization bytes for DC {file_id.dc_id}"
-                        )
-                        continue
-                else:
-                    await media_session.stop()
-                    raise AuthBytesInvalid
-            else:
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await client.storage.auth_key(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-            logging.debug(f"Created media session for DC {file_id.dc_id}")
-            client.media_sessions[file_id.dc_id] = media_session
-        else:
-            logging.debug(f"Using cached media session for DC {file_id.dc_id}")
-        return media_session
-
+        return file_id
 
     @staticmethod
     async def get_location(file_id: FileId) -> Union[raw.types.InputPhotoFileLocation,
@@ -151,7 +123,7 @@ class ByteStreamer:
         last_part_cut: int,
         part_count: int,
         chunk_size: int,
-    ) -> Union[str, None]:
+    ) -> AsyncGenerator[Union[bytes, memoryview], None]:
         """
         Custom generator that yields the bytes of the media file.
         Modded from <https://github.com/eyaadh/megadlbot_oss/blob/master/mega/telegram/utils/custom_download.py#L20>
@@ -160,55 +132,131 @@ class ByteStreamer:
         client = self.client
         work_loads[index] += 1
         logging.debug(f"Starting to yielding file with client {index}.")
-        media_session = await self.generate_media_session(client, file_id)
+        media_pool = get_media_pool(client)
 
         current_part = 1
 
         location = await self.get_location(file_id)
 
+        # Keep up to `window` GetFile requests in flight and hand them out in order
+        window = max(1, min(Server.READ_AHEAD, Server.READ_AHEAD_MAX_BYTES // chunk_size, part_count))
+        pending = deque()
+        requested = 0
+
         try:
-            r = await media_session.invoke(
-                raw.functions.upload.GetFile(
-                    location=location, offset=offset, limit=chunk_size
-                ),
-            )
-            if isinstance(r, raw.types.upload.File):
-                while True:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    elif part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                    elif current_part == 1:
-                        yield chunk[first_part_cut:]
-                    elif current_part == part_count:
-                        yield chunk[:last_part_cut]
-                    else:
-                        yield chunk
-
-                    current_part += 1
-                    offset += chunk_size
-
-                    if current_part > part_count:
-                        break
-
-                    r = await media_session.invoke(
-                        raw.functions.upload.GetFile(
-                            location=location, offset=offset, limit=chunk_size
-                        ),
-                    )
+            while current_part <= part_count:
+                while len(pending) < window and requested < part_count:
+                    pending.append(asyncio.ensure_future(
+                        self.get_chunk(file_id, index, media_pool, location, offset + requested * chunk_size, chunk_size)
+                    ))
+                    requested += 1
+
+                chunk = await pending.popleft()
+                if not chunk:
+                    break
+                # memoryview slices share the chunk instead of copying up to 1 MiB per edge
+                elif part_count == 1:
+                    chunk = memoryview(chunk)[first_part_cut:last_part_cut]
+                elif current_part == 1:
+                    chunk = memoryview(chunk)[first_part_cut:]
+                elif current_part == part_count:
+                    chunk = memoryview(chunk)[:last_part_cut]
+                yield chunk
+
+                current_part += 1
         except (TimeoutError, AttributeError):
             pass
         finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
             logging.debug(f"Finished yielding file with {current_part} parts.")
             work_loads[index] -= 1
 
-    
-    async def clean_cache(self) -> None:
+    @classmethod
+    async def get_chunk(cls, file_id: FileId, index: int, media_pool: MediaSessionPool, location, offset: int, chunk_size: int) -> bytes:
         """
-        function to clean the cache to reduce memory usage
+        Returns a single chunk of the media file, empty bytes if Telegram returned no data.
+        Concurrent requests for the same chunk, from any client, share one in-flight fetch,
+        which is cancelled once every stream waiting on it has gone away.
         """
-        while True:
-            await asyncio.sleep(self.clean_timer)
-            self.cached_file_ids.clear()
-            logging.debug("Cleaned the cache")
+        key = (file_id.media_id, offset, chunk_size)
+        task = cls.inflight_chunks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(cls.fetch_chunk(file_id, index, media_pool, location, offset, chunk_size))
+            cls.inflight_chunks[key] = task
+            task.add_done_callback(lambda t: cls.release_chunk(key, t))
+        else:
+            logging.debug(f"Joining in-flight fetch of chunk {offset} for media {file_id.media_id}")
+        cls.inflight_waiters[task] = cls.inflight_waiters.get(task, 0) + 1
+        try:
+            # shield() so that a viewer disconnecting does not cancel the fetch for the others
+            return await asyncio.shield(task)
+        finally:
+            cls.inflight_waiters[task] -= 1
+            if not cls.inflight_waiters[task]:
+                del cls.inflight_waiters[task]
+                if not task.done():
+                    # Nobody wants this chunk anymore, and nobody new may join a cancelled fetch
+                    if cls.inflight_chunks.get(key) is task:
+                        del cls.inflight_chunks[key]
+                    task.cancel()
+
+    @classmethod
+    def release_chunk(cls, key, task: asyncio.Task):
+        if cls.inflight_chunks.get(key) is task:
+            del cls.inflight_chunks[key]
+        if not task.cancelled():
+            task.exception()
+
+    @staticmethod
+    async def fetch_chunk(file_id: FileId, index: int, media_pool: MediaSessionPool, location, offset: int, chunk_size: int) -> bytes:
+        """
+        Fetches a single chunk from the shared chunk cache, or from Telegram on a miss.
+        A media session that stops answering is replaced and the request retried once on another one.
+        The outcome of every GetFile is reported to the client scheduler.
+        """
+        chunk = await chunk_cache.get(file_id.unique_id, offset, chunk_size)
+        if chunk is not None:
+            return chunk
+        if chunk_size < MAX_CHUNK_SIZE:
+            # A small chunk may be part of a full-size chunk already cached
+            full_offset = offset - offset % MAX_CHUNK_SIZE
+            chunk = await chunk_cache.get(file_id.unique_id, full_offset, MAX_CHUNK_SIZE)
+            if chunk is not None:
+                return chunk[offset - full_offset:offset - full_offset + chunk_size]
+
+        for attempt in range(2):
+            media_session = await media_pool.get(file_id.dc_id)
+            scheduler.begin_fetch(index, chunk_size)
+            start = time.monotonic()
+            try:
+                r = await media_session.invoke(
+                    raw.functions.upload.GetFile(
+                        location=location, offset=offset, limit=chunk_size
+                    ),
+                )
+                break
+            except FloodWait as e:
+                scheduler.record_flood_wait(index, e.value)
+                FLOOD_WAITS.inc(client=index)
+                raise
+            except (OSError, TimeoutError) as e:
+                scheduler.record_error(index)
+                GETFILE_ERRORS.inc(client=index, dc=file_id.dc_id, error=type(e).__name__)
+                await media_pool.discard(file_id.dc_id, media_session)
+                if attempt:
+                    raise
+            except Exception as e:
+                scheduler.record_error(index)
+                GETFILE_ERRORS.inc(client=index, dc=file_id.dc_id, error=type(e).__name__)
+                raise
+            finally:
+                scheduler.end_fetch(index, chunk_size)
+        elapsed = time.monotonic() - start
+        scheduler.record_chunk(index, len(getattr(r, "bytes", b"")), elapsed)
+        GETFILE_SECONDS.observe(elapsed, client=index, dc=file_id.dc_id)
+        if not isinstance(r, raw.types.upload.File):
+            return b""
+        await chunk_cache.put(file_id.unique_id, offset, chunk_size, r.bytes)
+        return r.bytes
@@ -1,13 +1,26 @@
 import os
 import json
+import time
+import asyncio
 import logging
+import pymongo
+import motor.motor_asyncio
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from FileStream.config import Telegram
+from FileStream.utils.metrics import DB_SECONDS, timed
 
 class FIleNotFound(Exception):
-    pass
+    message = "File not found"
 
 class Database:
+    # Número de operaciones en el log antes de reescribir el snapshot
+    COMPACT_EVERY = 1000
+
     def __init__(self, db_url=None, session_name="FileStreamBot"):
         self.session_name = session_name
+        # Funciones llamadas con el _id de cada archivo borrado, p. ej. para invalidar cachés
+        self.on_file_deleted = []
 
         # Si no hay DATABASE_URL, usar JSON local
         if not db_url or db_url.strip() == "":
@@ -15,19 +28,56 @@ class Database:
             self.db_path = os.path.join(
                 os.path.dirname(__file__), "database.json"
             )
+            self.log_path = self.db_path + ".log"
             self.use_local = True
         else:
-            # Si es MongoDB u otro backend
+            # Si es MongoDB: motor no conecta hasta la primera operación
             self.db_path = db_url
             self.use_local = False
+            self._client = motor.motor_asyncio.AsyncIOMotorClient(db_url)
+            self.mongo = self._client[session_name]
+            self.col = self.mongo.users
+            self.black = self.mongo.blacklist
+            self.file = self.mongo.file
+            self.broadcasts = self.mongo.broadcasts
+            self.nodes = self.mongo.nodes
 
         self.local_data = {}
-        self.load_local()
+        # Nodos del cluster en local: solo en memoria, no se comparten entre procesos
+        self.local_nodes = {}
+        self.loaded = False
+        self.log_file = None
+        self.log_entries = 0
+        # Número de la última operación aplicada en memoria; el snapshot guarda el suyo
+        self.seq = 0
+        self.next_file_id = 1
+        self.write_lock = asyncio.Lock()
+
+    @property
+    def local(self) -> dict:
+        """
+        Datos locales en memoria, cargados la primera vez que se usan.
+        """
+        if not self.loaded:
+            self.load_local()
+        return self.local_data
+
+    async def create_indexes(self):
+        """
+        Crea los índices de MongoDB. `_id` ya está indexado por defecto.
+        """
+        if not self.use_local:
+            await self.col.create_index("id", unique=True)
+            await self.black.create_index("id", unique=True)
+            await self.file.create_index("user_id")
+            await self.file.create_index("file_unique_id")
+            await self.nodes.create_index("updated")
 
     # ---------------------------------------------------------------------
-    # Carga la base de datos local (JSON)
+    # Carga la base de datos local: snapshot JSON + log de operaciones
     # ---------------------------------------------------------------------
     def load_local(self):
+        self.loaded = True
         if self.use_local:
             if not os.path.exists(self.db_path):
                 logging.warning(f"[DB] No existe {self.db_path}, creando nuevo archivo...")
@@ -36,61 +86,429 @@ class Database:
 
             try:
                 with open(self.db_path, "r") as f:
-                    self.local_data = json.load(f)
+                    data = json.load(f)
             except json.JSONDecodeError:
                 logging.error(f"[DB] Archivo {self.db_path} corrupto, recreando...")
-                self.local_data = {"users": [], "files": {}, "blacklist": []}
-                self.save_local()
+                data = {"users": [], "files": {}, "blacklist": []}
+
+            # Índices en memoria: usuarios y blacklist como set, archivos por _id y por usuario
+            self.local_data = {
+                "users": set(data.get("users", [])),
+                "files": {},
+                "blacklist": set(data.get("blacklist", [])),
+                "links": {int(k): v for k, v in data.get("links", {}).items()},
+                "user_files": {},
+                "unique_files": {},
+                "broadcasts": data.get("broadcasts", {}),
+            }
+            self.seq = data.get("seq", 0)
+            for file_info in data.get("files", {}).values():
+                self.apply({"op": "add_file", "file": file_info})
+
+            if os.path.exists(self.log_path):
+                with open(self.log_path, "r") as f:
+                    for line in f:
+                        try:
+                            op = json.loads(line)
+                            # Operaciones ya incluidas en el snapshot (p. ej. registradas tras una compactación)
+                            if op.get("seq", self.seq + 1) <= self.seq:
+                                continue
+                            self.apply(op)
+                            self.seq = max(self.seq, op.get("seq", self.seq))
+                        except (json.JSONDecodeError, KeyError, ValueError, AttributeError):
+                            logging.warning(f"[DB] Entrada inválida en {self.log_path}, ignorando: {line!r}")
+                            continue
+                        self.log_entries += 1
+
+            # Incorporar el log al snapshot y empezar uno nuevo
+            self.save_local()
+            self.log_file = open(self.log_path, "a")
+            self.log_file.truncate(0)
 
     # ---------------------------------------------------------------------
     def save_local(self):
+        """
+        Reescribe el snapshot completo de forma atómica.
+        """
         if self.use_local:
-            with open(self.db_path, "w") as f:
-                json.dump(self.local_data, f, indent=4)
+            self.write_snapshot(self.dump_local())
+
+    def dump_local(self) -> str:
+        return json.dumps({
+            "users": sorted(self.local["users"]),
+            "files": self.local["files"],
+            "blacklist": sorted(self.local["blacklist"]),
+            "links": self.local["links"],
+            "broadcasts": self.local["broadcasts"],
+            "seq": self.seq,
+        }, indent=4) + "\n"
+
+    def write_snapshot(self, snapshot: str):
+        tmp_path = self.db_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.db_path)
+
+    def apply(self, op: dict):
+        """
+        Aplica una operación del log sobre los datos en memoria.
+        """
+        kind = op["op"]
+        if kind == "add_user":
+            self.local["users"].add(op["user_id"])
+        elif kind == "delete_user":
+            self.local["users"].discard(op["user_id"])
+        elif kind == "delete_users":
+            self.local["users"].difference_update(op["user_ids"])
+        elif kind == "ban_user":
+            self.local["blacklist"].add(op["user_id"])
+        elif kind == "unban_user":
+            self.local["blacklist"].discard(op["user_id"])
+        elif kind == "count_links":
+            links = self.local["links"]
+            links[op["user_id"]] = links.get(op["user_id"], 0) + op["inc"]
+        elif kind == "add_file":
+            file_info = op["file"]
+            if file_info["_id"] in self.local["files"]:
+                return
+            self.local["files"][file_info["_id"]] = file_info
+            self.local["user_files"].setdefault(file_info.get("user_id"), []).append(file_info["_id"])
+            self.local["unique_files"].setdefault(file_info.get("file_unique_id"), []).append(file_info["_id"])
+            if file_info["_id"].isdigit():
+                self.next_file_id = max(self.next_file_id, int(file_info["_id"]) + 1)
+        elif kind == "update_file_ids":
+            file_info = self.local["files"][op["_id"]]
+            file_info.setdefault("file_ids", {}).update(op["file_ids"])
+            if op.get("log_msg_id") is not None:
+                file_info["log_msg_id"] = op["log_msg_id"]
+        elif kind == "delete_file":
+            file_info = self.local["files"].pop(op["_id"])
+            self.local["user_files"][file_info.get("user_id")].remove(op["_id"])
+            self.local["unique_files"][file_info.get("file_unique_id")].remove(op["_id"])
+        elif kind == "save_broadcast":
+            self.local["broadcasts"][op["broadcast"]["_id"]] = op["broadcast"]
+        elif kind == "delete_broadcast":
+            self.local["broadcasts"].pop(op["_id"], None)
+        else:
+            raise KeyError(kind)
+
+    async def commit(self, op: dict):
+        """
+        Aplica la operación en memoria y la añade al log fuera del event loop.
+        Cada operación lleva un número: una compactación puede escribir en el snapshot
+        operaciones aún no registradas, que al cargar se saltan en vez de aplicarse dos veces.
+        """
+        self.seq += 1
+        op["seq"] = self.seq
+        self.apply(op)
+        line = json.dumps(op) + "\n"
+        async with self.write_lock:
+            await asyncio.to_thread(self.append_log, line)
+            self.log_entries += 1
+            if self.log_entries >= self.COMPACT_EVERY:
+                await self.compact()
+
+    def append_log(self, line: str):
+        self.log_file.write(line)
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+
+    async def compact(self):
+        snapshot = self.dump_local()
+        await asyncio.to_thread(self.write_snapshot, snapshot)
+        self.log_file.truncate(0)
+        self.log_entries = 0
+        logging.debug(f"[DB] Log compactado en {self.db_path}")
 
     # ---------------------------------------------------------------------
     # Métodos para usuarios
     # ---------------------------------------------------------------------
+    @timed(DB_SECONDS, operation="add_user")
     async def add_user(self, user_id):
         if self.use_local:
-            if user_id not in self.local_data["users"]:
-                self.local_data["users"].append(user_id)
-                self.save_local()
+            if user_id not in self.local["users"]:
+                await self.commit({"op": "add_user", "user_id": user_id})
+        else:
+            await self.col.update_one(
+                {"id": int(user_id)},
+                {"$setOnInsert": {"id": int(user_id), "join_date": time.time(), "Links": 0}},
+                upsert=True,
+            )
 
+    @timed(DB_SECONDS, operation="get_user")
     async def get_user(self, user_id):
         if self.use_local:
-            return user_id in self.local_data.get("users", [])
-        return False
+            return user_id in self.local["users"]
+        return await self.col.find_one({"id": int(user_id)})
 
+    @timed(DB_SECONDS, operation="delete_user")
+    async def delete_user(self, user_id):
+        if self.use_local:
+            if user_id in self.local["users"]:
+                await self.commit({"op": "delete_user", "user_id": user_id})
+        else:
+            await self.col.delete_many({"id": int(user_id)})
+
+    @timed(DB_SECONDS, operation="delete_users")
+    async def delete_users(self, user_ids: list):
+        """
+        Borra varios usuarios con una sola operación.
+        """
+        if not user_ids:
+            return
+        if self.use_local:
+            await self.commit({"op": "delete_users", "user_ids": list(user_ids)})
+        else:
+            await self.col.delete_many({"id": {"$in": [int(user_id) for user_id in user_ids]}})
+
+    @timed(DB_SECONDS, operation="total_users_count")
+    async def total_users_count(self):
+        if self.use_local:
+            return len(self.local["users"])
+        return await self.col.count_documents({})
+
+    @timed(DB_SECONDS, operation="get_all_users")
+    async def get_all_users(self, after=None):
+        """
+        Devuelve un iterable asíncrono de documentos {"id": user_id} ordenados por id.
+        Con `after` solo los usuarios con id mayor, para reanudar un recorrido.
+        """
+        if self.use_local:
+            return self.iter_local_users(after)
+        query = {} if after is None else {"id": {"$gt": int(after)}}
+        return self.col.find(query, {"id": 1}).sort("id", pymongo.ASCENDING)
+
+    async def iter_local_users(self, after=None):
+        # Copia ordenada para poder borrar usuarios mientras se recorre
+        for user_id in sorted(self.local["users"]):
+            if after is None or user_id > after:
+                yield {"id": user_id}
+
+    @timed(DB_SECONDS, operation="count_links")
+    async def count_links(self, user_id, operation: str):
+        inc = 1 if operation == "+" else -1
+        if self.use_local:
+            await self.commit({"op": "count_links", "user_id": user_id, "inc": inc})
+        else:
+            await self.col.update_one({"id": int(user_id)}, {"$inc": {"Links": inc}})
+
+    # ---------------------------------------------------------------------
+    # Métodos para la blacklist
+    # ---------------------------------------------------------------------
+    @timed(DB_SECONDS, operation="ban_user")
+    async def ban_user(self, user_id):
+        if self.use_local:
+            if user_id not in self.local["blacklist"]:
+                await self.commit({"op": "ban_user", "user_id": user_id})
+        else:
+            await self.black.update_one(
+                {"id": int(user_id)},
+                {"$setOnInsert": {"id": int(user_id), "ban_date": time.time()}},
+                upsert=True,
+            )
+
+    @timed(DB_SECONDS, operation="unban_user")
+    async def unban_user(self, user_id):
+        if self.use_local:
+            if user_id in self.local["blacklist"]:
+                await self.commit({"op": "unban_user", "user_id": user_id})
+        else:
+            await self.black.delete_one({"id": int(user_id)})
+
+    @timed(DB_SECONDS, operation="is_user_banned")
     async def is_user_banned(self, user_id):
         if self.use_local:
-            return user_id in self.local_data.get("blacklist", [])
-        return False
+            return user_id in self.local["blacklist"]
+        return bool(await self.black.find_one({"id": int(user_id)}))
+
+    @timed(DB_SECONDS, operation="total_banned_users_count")
+    async def total_banned_users_count(self):
+        if self.use_local:
+            return len(self.local["blacklist"])
+        return await self.black.count_documents({})
 
     # ---------------------------------------------------------------------
     # Métodos para archivos
     # ---------------------------------------------------------------------
+    @timed(DB_SECONDS, operation="add_file")
     async def add_file(self, file_info: dict):
         """
-        Guarda un archivo en la base de datos local.
+        Guarda un archivo en la base de datos.
         Genera un ID interno (_id) único para cada archivo.
         """
+        file_info["time"] = time.time()
         if self.use_local:
             # Generar un _id simple
-            _id = str(len(self.local_data["files"]) + 1)
+            _id = str(self.next_file_id)
             file_info["_id"] = _id
-            self.local_data["files"][_id] = file_info
-            self.save_local()
-            return _id
+            await self.commit({"op": "add_file", "file": file_info})
+        else:
+            _id = (await self.file.insert_one(file_info)).inserted_id
+        await self.count_links(file_info["user_id"], "+")
+        return _id
 
-    async def get_file(self, _id: str):
+    @timed(DB_SECONDS, operation="get_file")
+    async def get_file(self, _id):
         if self.use_local:
-            if _id in self.local_data["files"]:
-                return self.local_data["files"][_id]
+            if _id in self.local["files"]:
+                return self.local["files"][_id]
+            raise FIleNotFound
+        try:
+            file_info = await self.file.find_one({"_id": ObjectId(_id)})
+        except InvalidId:
+            raise FIleNotFound
+        if not file_info:
             raise FIleNotFound
-        raise FIleNotFound
+        return file_info
 
-    async def update_file_ids(self, _id: str, file_ids: dict):
-        if self.use_local and _id in self.local_data["files"]:
-            self.local_data["files"][_id]["file_ids"] = file_ids
-            self.save_local()
+    @timed(DB_SECONDS, operation="get_file_by_unique_id")
+    async def get_file_by_unique_id(self, file_unique_id):
+        """
+        Devuelve el registro más reciente del mismo archivo de Telegram que ya
+        tenga sus file_id resueltos, o None si no se había subido antes.
+        """
+        if not file_unique_id:
+            return None
+        if self.use_local:
+            for _id in reversed(self.local["unique_files"].get(file_unique_id, [])):
+                file_info = self.local["files"][_id]
+                if file_info.get("file_ids"):
+                    return file_info
+            return None
+        return await self.file.find_one(
+            {"file_unique_id": file_unique_id, "file_ids": {"$exists": True, "$ne": {}}},
+            sort=[("_id", pymongo.DESCENDING)],
+        )
+
+    @timed(DB_SECONDS, operation="find_files")
+    async def find_files(self, user_id, range: list):
+        """
+        Devuelve los archivos del usuario entre las posiciones range[0] y range[1]
+        (empezando en 1, más recientes primero) y el total de archivos del usuario.
+        """
+        if self.use_local:
+            ids = self.local["user_files"].get(user_id, [])
+            page = ids[::-1][range[0] - 1:range[1]]
+            return self.iter_local_files(page), len(ids)
+        user_files = self.file.find({"user_id": user_id})
+        user_files.sort("_id", pymongo.DESCENDING)
+        user_files.skip(range[0] - 1)
+        user_files.limit(range[1] - range[0] + 1)
+        total_files = await self.file.count_documents({"user_id": user_id})
+        return user_files, total_files
+
+    async def iter_local_files(self, ids: list):
+        for _id in ids:
+            if _id in self.local["files"]:
+                yield self.local["files"][_id]
+
+    @timed(DB_SECONDS, operation="total_files")
+    async def total_files(self, user_id=None):
+        if self.use_local:
+            if user_id is None:
+                return len(self.local["files"])
+            return len(self.local["user_files"].get(user_id, []))
+        if user_id is None:
+            return await self.file.count_documents({})
+        return await self.file.count_documents({"user_id": user_id})
+
+    @timed(DB_SECONDS, operation="delete_one_file")
+    async def delete_one_file(self, _id):
+        if self.use_local:
+            if _id in self.local["files"]:
+                await self.commit({"op": "delete_file", "_id": _id})
+        else:
+            await self.file.delete_one({"_id": ObjectId(_id)})
+        for callback in self.on_file_deleted:
+            callback(str(_id))
+
+    @timed(DB_SECONDS, operation="update_file_ids")
+    async def update_file_ids(self, _id, file_ids: dict, log_msg_id=None):
+        """
+        Añade los file_id por cliente al registro, conservando los existentes,
+        y opcionalmente el id del mensaje en FLOG_CHANNEL del que se obtuvieron.
+        """
+        if self.use_local:
+            if _id in self.local["files"]:
+                op = {"op": "update_file_ids", "_id": _id, "file_ids": file_ids}
+                if log_msg_id is not None:
+                    op["log_msg_id"] = log_msg_id
+                await self.commit(op)
+        else:
+            # Un único update con un $set por cliente
+            fields = {f"file_ids.{client_id}": value for client_id, value in file_ids.items()}
+            if log_msg_id is not None:
+                fields["log_msg_id"] = log_msg_id
+            if fields:
+                await self.file.update_one({"_id": ObjectId(_id)}, {"$set": fields})
+
+    # ---------------------------------------------------------------------
+    # Estado de los broadcasts en curso, para reanudarlos tras un reinicio
+    # ---------------------------------------------------------------------
+    @timed(DB_SECONDS, operation="save_broadcast")
+    async def save_broadcast(self, broadcast: dict):
+        if self.use_local:
+            await self.commit({"op": "save_broadcast", "broadcast": broadcast})
+        else:
+            await self.broadcasts.replace_one({"_id": broadcast["_id"]}, broadcast, upsert=True)
+
+    @timed(DB_SECONDS, operation="get_broadcasts")
+    async def get_broadcasts(self) -> list:
+        if self.use_local:
+            return list(self.local["broadcasts"].values())
+        return await self.broadcasts.find({}).to_list(length=None)
+
+    @timed(DB_SECONDS, operation="claim_broadcast")
+    async def claim_broadcast(self, broadcast_id: str, owner: str, stale_before: float):
+        """
+        Marca el broadcast como propio si no tiene dueño, ya es de `owner` o su dueño
+        no lo ha guardado desde `stale_before`. Devuelve el estado reclamado o None.
+        """
+        if self.use_local:
+            broadcast = self.local["broadcasts"].get(broadcast_id)
+            if broadcast is None or broadcast.get("owner") not in (None, owner) and broadcast.get("claimed", 0) >= stale_before:
+                return None
+            broadcast = dict(broadcast, owner=owner, claimed=time.time())
+            await self.commit({"op": "save_broadcast", "broadcast": broadcast})
+            return broadcast
+        # find_one_and_update es atómico: solo un proceso puede ganar el reclamo
+        return await self.broadcasts.find_one_and_update(
+            {"_id": broadcast_id, "$or": [
+                {"owner": {"$exists": False}},
+                {"owner": owner},
+                {"claimed": {"$lt": stale_before}},
+            ]},
+            {"$set": {"owner": owner, "claimed": time.time()}},
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+
+    @timed(DB_SECONDS, operation="delete_broadcast")
+    async def delete_broadcast(self, broadcast_id: str):
+        if self.use_local:
+            if broadcast_id in self.local["broadcasts"]:
+                await self.commit({"op": "delete_broadcast", "_id": broadcast_id})
+        else:
+            await self.broadcasts.delete_one({"_id": broadcast_id})
+
+    # ---------------------------------------------------------------------
+    # Nodos del cluster: carga y archivos recientes publicados por cada nodo
+    # ---------------------------------------------------------------------
+    async def save_node(self, node: dict):
+        if self.use_local:
+            self.local_nodes[node["_id"]] = node
+        else:
+            await self.nodes.replace_one({"_id": node["_id"]}, node, upsert=True)
+
+    async def get_nodes(self, since: float) -> list:
+        """
+        Devuelve los nodos que han publicado su estado después de `since`.
+        """
+        if self.use_local:
+            return [node for node in self.local_nodes.values() if node["updated"] >= since]
+        return await self.nodes.find({"updated": {"$gte": since}}).to_list(length=None)
+
+
+# Instancia única compartida por todo el proceso
+db = Database(Telegram.DATABASE_URL, Telegram.SESSION_NAME)
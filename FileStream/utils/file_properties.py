@@ -1,25 +1,27 @@
 from __future__ import annotations
+import asyncio
 import logging
 from datetime import datetime
 from pyrogram import Client
 from typing import Any, Optional
 
 from pyrogram.enums import ParseMode, ChatType
+from pyrogram.errors import FloodWait
 from pyrogram.types import Message
 from pyrogram.file_id import FileId
 from FileStream.bot import FileStream
-from FileStream.utils.database import Database
+from FileStream.utils.database import db
+from FileStream.utils.metrics import FILE_ID_RESOLUTIONS
 from FileStream.config import Telegram
 
-db = Database(Telegram.DATABASE_URL, Telegram.SESSION_NAME)
-
 async def get_file_ids(client: Client | bool, db_id: str, multi_clients, message) -> Optional[FileId]:
     logging.debug("Starting of get_file_ids")
     file_info = await db.get_file(db_id)
     if (not "file_ids" in file_info) or not client:
         logging.debug("Storing file_id of all clients in DB")
+        FILE_ID_RESOLUTIONS.inc(source="all_clients")
         log_msg = await send_file(FileStream, db_id, file_info['file_id'], message)
-        await db.update_file_ids(db_id, await update_file_id(log_msg.id, multi_clients))
+        await db.update_file_ids(db_id, await update_file_id(log_msg.id, multi_clients), log_msg.id)
         logging.debug("Stored file_id of all clients in DB")
         if not client:
             return
@@ -27,6 +29,7 @@ async def get_file_ids(client: Client | bool, db_id: str, multi_clients, message
 
     file_id_info = file_info.setdefault("file_ids", {})
     if not str(client.id) in file_id_info:
+        FILE_ID_RESOLUTIONS.inc(source="telegram")
         logging.debug("Storing file_id in DB")
         log_msg = await send_file(FileStream, db_id, file_info['file_id'], message)
         msg = await client.get_messages(Telegram.FLOG_CHANNEL, log_msg.id)
@@ -34,6 +37,8 @@ async def get_file_ids(client: Client | bool, db_id: str, multi_clients, message
         file_id_info[str(client.id)] = getattr(media, "file_id", "")
         await db.update_file_ids(db_id, file_id_info)
         logging.debug("Stored file_id in DB")
+    else:
+        FILE_ID_RESOLUTIONS.inc(source="db")
 
     logging.debug("Middle of get_file_ids")
     file_id = FileId.decode(file_id_info[str(client.id)])
@@ -41,6 +46,7 @@ async def get_file_ids(client: Client | bool, db_id: str, multi_clients, message
     setattr(file_id, "mime_type", file_info['mime_type'])
     setattr(file_id, "file_name", file_info['file_name'])
     setattr(file_id, "unique_id", file_info['file_unique_id'])
+    setattr(file_id, "time", file_info.get('time'))
     logging.debug("Ending of get_file_ids")
     return file_id
 
@@ -91,6 +97,28 @@ def get_name(media_msg: Message | FileId) -> str:
 
     return file_name
 
+async def add_file(message, multi_clients):
+    """
+    Stores a received media and returns its new _id. A media whose file_unique_id
+    was ingested before reuses the file_ids of that record instead of being sent
+    to FLOG_CHANNEL and resolved on every client again.
+    """
+    file_info = get_file_info(message)
+    existing = await db.get_file_by_unique_id(file_info["file_unique_id"])
+    if existing is None:
+        inserted_id = await db.add_file(file_info)
+        await get_file_ids(False, inserted_id, multi_clients, message)
+        return inserted_id
+
+    logging.debug(f"Reusing file_ids of {existing['_id']} for {file_info['file_unique_id']}")
+    file_info["file_ids"] = dict(existing["file_ids"])
+    if existing.get("log_msg_id") is not None:
+        file_info["log_msg_id"] = existing["log_msg_id"]
+    inserted_id = await db.add_file(file_info)
+    if existing.get("log_msg_id") is not None:
+        await send_request_log(FileStream, existing["log_msg_id"], inserted_id, message)
+    return inserted_id
+
 def get_file_info(message):
     media = get_media_from_message(message)
     if message.chat.type == ChatType.PRIVATE:
@@ -107,26 +135,48 @@ def get_file_info(message):
     }
 
 async def update_file_id(msg_id, multi_clients):
-    file_ids = {}
-    for client_id, client in multi_clients.items():
-        log_msg = await client.get_messages(Telegram.FLOG_CHANNEL, msg_id)
+    """
+    Resolves the file_id of the log message for every client concurrently.
+    Clients that are flood limited, fail or take longer than FILE_ID_TIMEOUT (pyrogram sleeps
+    through short FloodWaits itself) are left out, get_file_ids resolves them later on demand.
+    """
+    semaphore = asyncio.Semaphore(Telegram.FILE_ID_CONCURRENCY)
+
+    async def resolve(client):
+        async with semaphore:
+            try:
+                log_msg = await asyncio.wait_for(
+                    client.get_messages(Telegram.FLOG_CHANNEL, msg_id), Telegram.FILE_ID_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                logging.warning(f"Client {client.id} took over {Telegram.FILE_ID_TIMEOUT}s, skipping file_id resolution")
+                return None
+            except FloodWait as e:
+                logging.warning(f"Client {client.id} got FloodWait of {e.value}s, skipping file_id resolution")
+                return None
+            except Exception:
+                logging.error(f"Client {client.id} failed resolving file_id of message {msg_id}", exc_info=True)
+                return None
         media = get_media_from_message(log_msg)
-        file_ids[str(client.id)] = getattr(media, "file_id", "")
+        return str(client.id), getattr(media, "file_id", "")
 
-    return file_ids
+    results = await asyncio.gather(*[resolve(client) for client in multi_clients.values()])
+    return dict(result for result in results if result)
 
 async def send_file(client: Client, db_id, file_id: str, message):
     file_caption = getattr(message, 'caption', None) or get_name(message)
     log_msg = await client.send_cached_media(chat_id=Telegram.FLOG_CHANNEL, file_id=file_id,
                                              caption=f'**{file_caption}**')
+    await send_request_log(client, log_msg.id, db_id, message)
+    return log_msg
 
+async def send_request_log(client: Client, log_msg_id: int, db_id, message):
+    """
+    Replies to the media in FLOG_CHANNEL with who requested the record `db_id`.
+    """
     if message.chat.type == ChatType.PRIVATE:
-        await log_msg.reply_text(
-            text=f"**RᴇQᴜᴇꜱᴛᴇᴅ ʙʏ :** [{message.from_user.first_name}](tg://user?id={message.from_user.id})\n**Uꜱᴇʀ ɪᴅ :** `{message.from_user.id}`\n**Fɪʟᴇ ɪᴅ :** `{db_id}`",
-            disable_web_page_preview=True, parse_mode=ParseMode.MARKDOWN, quote=True)
+        text = f"**RᴇQᴜᴇꜱᴛᴇᴅ ʙʏ :** [{message.from_user.first_name}](tg://user?id={message.from_user.id})\n**Uꜱᴇʀ ɪᴅ :** `{message.from_user.id}`\n**Fɪʟᴇ ɪᴅ :** `{db_id}`"
     else:
-        await log_msg.reply_text(
-            text=f"**RᴇQᴜᴇꜱᴛᴇᴅ ʙʏ :** {message.chat.title} \n**Cʜᴀɴɴᴇʟ ɪᴅ :** `{message.chat.id}`\n**Fɪʟᴇ ɪᴅ :** `{db_id}`",
-            disable_web_page_preview=True, parse_mode=ParseMode.MARKDOWN, quote=True)
-
-    return log_msg
+        text = f"**RᴇQᴜᴇꜱᴛᴇᴅ ʙʏ :** {message.chat.title} \n**Cʜᴀɴɴᴇʟ ɪᴅ :** `{message.chat.id}`\n**Fɪʟᴇ ɪᴅ :** `{db_id}`"
+    await client.send_message(chat_id=Telegram.FLOG_CHANNEL, text=text, reply_to_message_id=log_msg_id,
+                              disable_web_page_preview=True, parse_mode=ParseMode.MARKDOWN)
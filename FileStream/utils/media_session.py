@@ -0,0 +1,191 @@
+import time
+import asyncio
+import logging
+from typing import Dict, List
+from pyrogram import Client, raw
+from pyrogram.session import Session, Auth
+from pyrogram.errors import AuthBytesInvalid
+from FileStream.config import Server
+
+DC_IDS = (1, 2, 3, 4, 5)
+
+
+class MediaSessionPool:
+    """
+    Keeps up to `size` media sessions per DC for one client so that parallel
+    GetFile calls are spread over several MTProto connections. Sessions are
+    health-checked periodically and replaced when they stop answering.
+    """
+    FILL_BACKOFF = 30.0  # seconds before retrying a failed fill, doubled per consecutive failure
+    MAX_FILL_BACKOFF = 900.0
+
+    def __init__(self, client: Client, size: int):
+        self.client = client
+        self.size = max(1, size)
+        self.sessions: Dict[int, List[Session]] = {}
+        self.counters: Dict[int, int] = {}
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.fills: Dict[int, asyncio.Task] = {}
+        self.fill_failures: Dict[int, int] = {}
+        self.fill_retry_at: Dict[int, float] = {}
+        self.keepalive_task = None
+
+    def lock(self, dc_id: int) -> asyncio.Lock:
+        if dc_id not in self.locks:
+            self.locks[dc_id] = asyncio.Lock()
+        return self.locks[dc_id]
+
+    async def get(self, dc_id: int) -> Session:
+        """
+        Returns a media session for the DC, round robin over the pool.
+        Only the first session of a DC is created on the request path, the rest are filled in the background
+        by one task per DC at a time, backing off after failures so a DC that refuses extra
+        sessions does not get an authorization export on every chunk.
+        """
+        self.start_keepalive()
+        sessions = self.sessions.get(dc_id)
+        if not sessions:
+            async with self.lock(dc_id):
+                sessions = self.sessions.get(dc_id)
+                if not sessions:
+                    sessions = self.sessions[dc_id] = [await self.create_session(dc_id)]
+        if len(sessions) < self.size:
+            self.fill_in_background(dc_id)
+        self.counters[dc_id] = (self.counters.get(dc_id, 0) + 1) % len(sessions)
+        return sessions[self.counters[dc_id]]
+
+    def fill_in_background(self, dc_id: int):
+        fill = self.fills.get(dc_id)
+        if fill is not None and not fill.done() or self.lock(dc_id).locked():
+            return
+        if time.monotonic() < self.fill_retry_at.get(dc_id, 0):
+            return
+        self.fills[dc_id] = asyncio.create_task(self.fill(dc_id))
+
+    async def fill(self, dc_id: int):
+        async with self.lock(dc_id):
+            sessions = self.sessions.setdefault(dc_id, [])
+            while len(sessions) < self.size:
+                try:
+                    sessions.append(await self.create_session(dc_id))
+                except Exception:
+                    failures = self.fill_failures[dc_id] = self.fill_failures.get(dc_id, 0) + 1
+                    backoff = min(self.FILL_BACKOFF * 2 ** (failures - 1), self.MAX_FILL_BACKOFF)
+                    self.fill_retry_at[dc_id] = time.monotonic() + backoff
+                    logging.warning(
+                        f"Could not add media session for DC {dc_id} to client {self.client.name}, retrying in {backoff:.0f}s",
+                        exc_info=True,
+                    )
+                    return
+            self.fill_failures.pop(dc_id, None)
+            self.fill_retry_at.pop(dc_id, None)
+
+    async def warm(self, dc_ids=DC_IDS):
+        """
+        Pre-creates and health-checks the media sessions of every DC.
+        """
+        self.start_keepalive()
+        await asyncio.gather(*[self.fill(dc_id) for dc_id in dc_ids])
+        await self.check()
+        logging.info(f"Warmed {sum(map(len, self.sessions.values()))} media sessions for client {self.client.name}")
+
+    async def discard(self, dc_id: int, session: Session):
+        """
+        Removes a broken session from the pool, the next get() replaces it.
+        """
+        sessions = self.sessions.get(dc_id, [])
+        if session in sessions:
+            sessions.remove(session)
+            if self.client.media_sessions.get(dc_id) is session:
+                self.client.media_sessions.pop(dc_id)
+            logging.debug(f"Discarded media session for DC {dc_id}")
+            try:
+                await session.stop()
+            except Exception:
+                pass
+
+    async def check(self):
+        for dc_id, sessions in list(self.sessions.items()):
+            for session in list(sessions):
+                try:
+                    await session.invoke(raw.functions.Ping(ping_id=0), retries=0, timeout=Server.MEDIA_SESSION_TIMEOUT)
+                except Exception:
+                    logging.warning(f"Media session for DC {dc_id} of client {self.client.name} is not answering, reconnecting")
+                    await self.discard(dc_id, session)
+
+    def start_keepalive(self):
+        if self.keepalive_task is None and Server.MEDIA_SESSION_KEEPALIVE > 0:
+            self.keepalive_task = asyncio.create_task(self.keepalive())
+
+    async def keepalive(self):
+        while True:
+            await asyncio.sleep(Server.MEDIA_SESSION_KEEPALIVE)
+            await self.check()
+            for dc_id, sessions in list(self.sessions.items()):
+                if len(sessions) < self.size:
+                    self.fill_in_background(dc_id)
+
+    async def create_session(self, dc_id: int) -> Session:
+        """
+        Generates a media session for the DC, importing the authorization when the DC is not the client's own.
+        The first session of each DC is also registered in client.media_sessions for pyrogram's own use.
+        """
+        client = self.client
+        cached = client.media_sessions.get(dc_id)
+        if cached is not None and cached not in self.sessions.get(dc_id, []):
+            logging.debug(f"Using cached media session for DC {dc_id}")
+            return cached
+
+        if dc_id != await client.storage.dc_id():
+            media_session = Session(
+                client,
+                dc_id,
+                await Auth(
+                    client, dc_id, await client.storage.test_mode()
+                ).create(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+
+            for _ in range(6):
+                exported_auth = await client.invoke(
+                    raw.functions.auth.ExportAuthorization(dc_id=dc_id)
+                )
+
+                try:
+                    await media_session.invoke(
+                        raw.functions.auth.ImportAuthorization(
+                            id=exported_auth.id, bytes=exported_auth.bytes
+                        )
+                    )
+                    break
+                except AuthBytesInvalid:
+                    logging.debug(
+                        f"Invalid authorization bytes for DC {dc_id}"
+                    )
+                    continue
+            else:
+                await media_session.stop()
+                raise AuthBytesInvalid
+        else:
+            media_session = Session(
+                client,
+                dc_id,
+                await client.storage.auth_key(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+        logging.debug(f"Created media session for DC {dc_id}")
+        client.media_sessions.setdefault(dc_id, media_session)
+        return media_session
+
+
+media_pools: Dict[Client, MediaSessionPool] = {}
+
+
+def get_media_pool(client: Client) -> MediaSessionPool:
+    if client not in media_pools:
+        media_pools[client] = MediaSessionPool(client, Server.MEDIA_SESSIONS_PER_DC)
+    return media_pools[client]
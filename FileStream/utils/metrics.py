@@ -0,0 +1,177 @@
+import time
+import bisect
+import functools
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Seconds, from a cached chunk to a slow cross-DC GetFile
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not labelnames:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(labelnames, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """
+    Base of the metrics exported in the Prometheus text format.
+    Samples are kept per tuple of label values, in the order of `labelnames`.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterable[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(names, values)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for values, value in self.values.items():
+            yield "", self.labelnames, values, value
+
+
+class Gauge(Metric):
+    """
+    Gauge whose samples are read from `collect` at scrape time, so that state
+    already tracked elsewhere (work_loads, cache counters) is not duplicated.
+    `collect` returns a mapping of label values tuples to numbers.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), collect: Callable[[], dict] = None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        for values, value in self.collect().items():
+            yield "", self.labelnames, tuple(map(str, values)), value
+
+
+class CallbackCounter(Gauge):
+    kind = "counter"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self.values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        for values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", names, values + ("+Inf" if bound == float("inf") else repr(bound),), cumulative
+            yield "_sum", self.labelnames, values, total
+            yield "_count", self.labelnames, values, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+BYTES_SERVED = registry.register(Counter(
+    "filestream_bytes_served_total", "Bytes streamed to HTTP clients.", ("client",)))
+GETFILE_SECONDS = registry.register(Histogram(
+    "filestream_getfile_seconds", "Latency of upload.GetFile calls.", ("client", "dc")))
+GETFILE_ERRORS = registry.register(Counter(
+    "filestream_getfile_errors_total", "Failed upload.GetFile calls.", ("client", "dc", "error")))
+FLOOD_WAITS = registry.register(Counter(
+    "filestream_flood_waits_total", "FloodWait errors received.", ("client",)))
+TIME_TO_FIRST_BYTE = registry.register(Histogram(
+    "filestream_time_to_first_byte_seconds", "Time from request to the first body byte.", ("route",)))
+HTTP_REQUESTS = registry.register(Counter(
+    "filestream_http_requests_total", "HTTP requests handled.", ("route", "method", "status")))
+HTTP_SECONDS = registry.register(Histogram(
+    "filestream_http_request_seconds", "Time until the response headers are ready.", ("route",)))
+FILE_ID_RESOLUTIONS = registry.register(Counter(
+    "filestream_file_id_resolutions_total", "file_id lookups by get_file_ids.", ("source",)))
+DB_SECONDS = registry.register(Histogram(
+    "filestream_db_operation_seconds", "Latency of database operations.", ("operation",)))
+SHAPER_REJECTIONS = registry.register(Counter(
+    "filestream_shaper_rejections_total", "Streams refused by the egress shaper.", ("reason",)))
+SHAPER_DELAYED_BYTES = registry.register(Counter(
+    "filestream_shaper_delayed_bytes_total", "Bytes held back by the egress shaper.", ("priority",)))
+
+
+def timed(histogram: Histogram, **labels):
+    """
+    Decorator observing the duration of a coroutine function in `histogram`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.monotonic() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def cache_counts(caches: Dict[str, object]) -> Callable[[], dict]:
+    """
+    Builds a collect function from objects with `hits` and `misses` counters.
+    """
+    def collect() -> dict:
+        values = {}
+        for name, cache in caches.items():
+            values[(name, "hit")] = cache.hits
+            values[(name, "miss")] = cache.misses
+        return values
+    return collect
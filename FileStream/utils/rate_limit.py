@@ -0,0 +1,57 @@
+import time
+import asyncio
+
+
+class TokenBucket:
+    """
+    Token bucket limiter: `rate` tokens per second, bursts of up to `capacity`.
+    Waiters are served in arrival order. pause() stops the bucket for a while,
+    e.g. for the duration of a FloodWait. A request for more than `capacity`
+    tokens waits for a full bucket and leaves it in debt, instead of never fitting.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, tokens: float = 1) -> float:
+        """
+        Seconds until `tokens` can be taken, 0 when they are available now.
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.refill(now)
+        needed = min(tokens, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        if self.delay(tokens):
+            return False
+        self.tokens -= tokens
+        return True
+
+    async def acquire(self, tokens: float = 1):
+        async with self.lock:
+            while True:
+                delay = self.delay(tokens)
+                if not delay:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0
+        self.updated = max(self.updated, self.paused_until)
@@ -1,37 +1,35 @@
-import aiohttp
 import jinja2
 import urllib.parse
-from FileStream.config import Telegram, Server
-from FileStream.utils.database import Database
+from FileStream.config import Server
+from FileStream.utils.cache import TTLCache
+from FileStream.utils.database import db
 from FileStream.utils.human_readable import humanbytes
 
-db = Database(Telegram.DATABASE_URL, Telegram.SESSION_NAME)
+# Plantillas compiladas una sola vez y páginas renderizadas por _id
+env = jinja2.Environment(loader=jinja2.FileSystemLoader("FileStream/template"), auto_reload=False)
+page_cache = TTLCache(Server.PAGE_CACHE_SIZE, Server.PAGE_CACHE_TTL)
+db.on_file_deleted.append(page_cache.pop)
 
 async def render_page(db_id):
+    html = page_cache.get(db_id)
+    if html is not None:
+        return html
+
     file_data = await db.get_file(db_id)
     src = urllib.parse.urljoin(Server.URL, f'dl/{file_data["_id"]}')
+    # El tamaño guardado es el mismo que /dl devolvería en Content-Length
     file_size = humanbytes(file_data['file_size'])
     file_name = file_data['file_name'].replace("_", " ")
     mime_type = file_data.get('mime_type', 'application/octet-stream')
 
-    if str(mime_type).split('/')[0].strip() != 'video':
-        # Para archivos que no son video, obtener tamaño real del recurso remoto
-        async with aiohttp.ClientSession() as session:
-            async with session.head(src) as resp:
-                if resp.status == 200:
-                    content_length = resp.headers.get('Content-Length')
-                    if content_length:
-                        file_size = humanbytes(int(content_length))
-
-    template_file = "FileStream/template/play.html" if mime_type.startswith('video/') else "FileStream/template/dl.html"
-
-    with open(template_file) as f:
-        template = jinja2.Template(f.read())
+    template = env.get_template("play.html" if mime_type.startswith('video/') else "dl.html")
 
-    return template.render(
+    html = template.render(
         file_name=file_name,
         file_url=src,
         file_size=file_size,
         mime_type=mime_type,
         file_id=file_data['_id']
     )
+    page_cache.set(db_id, html)
+    return html
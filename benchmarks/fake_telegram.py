@@ -0,0 +1,100 @@
+"""
+Local stand-in for the Telegram side of the streamer: clients whose media
+sessions answer upload.GetFile with deterministic bytes after a configurable
+latency and bandwidth, optionally raising FloodWait.
+"""
+import random
+import asyncio
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from pyrogram.file_id import FileId, FileType
+from FileStream.utils.media_session import MediaSessionPool, media_pools
+from FileStream.config import Server
+
+# Content of every fake file is this block repeated, a prime length keeps chunks distinct
+PATTERN = random.Random(0).randbytes(1048573)
+
+
+def file_bytes(offset: int, length: int) -> bytes:
+    """
+    Bytes offset..offset+length of any fake file.
+    """
+    start = offset % len(PATTERN)
+    data = PATTERN[start:start + length]
+    while len(data) < length:
+        data += PATTERN[:length - len(data)]
+    return data
+
+
+class Profile:
+    """
+    Behaviour of the fake DCs: per-call latency in seconds, per-session bandwidth
+    in bytes per second and the probability of a FloodWait of `flood_wait` seconds.
+    """
+
+    def __init__(self, latency: float = 0.05, bandwidth: float = 8 * 1024 * 1024, flood_rate: float = 0.0, flood_wait: int = 5, seed: int = 0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.flood_rate = flood_rate
+        self.flood_wait = flood_wait
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.bytes = 0
+        self.flood_waits = 0
+
+
+class FakeSession:
+    def __init__(self, profile: Profile, file_sizes: dict):
+        self.profile = profile
+        self.file_sizes = file_sizes
+
+    async def invoke(self, query, *args, **kwargs):
+        if isinstance(query, raw.functions.Ping):
+            return raw.types.Pong(msg_id=0, ping_id=query.ping_id)
+        if not isinstance(query, raw.functions.upload.GetFile):
+            raise NotImplementedError(type(query).__name__)
+
+        profile = self.profile
+        profile.calls += 1
+        if profile.flood_rate and profile.random.random() < profile.flood_rate:
+            profile.flood_waits += 1
+            raise FloodWait(value=profile.flood_wait)
+
+        file_size = self.file_sizes[query.location.id]
+        length = max(0, min(query.limit, file_size - query.offset))
+        await asyncio.sleep(profile.latency + length / profile.bandwidth)
+        profile.bytes += length
+        return raw.types.upload.File(
+            type=raw.types.storage.FilePartial(), mtime=0, bytes=file_bytes(query.offset, length)
+        )
+
+    async def stop(self):
+        pass
+
+
+class FakeMediaSessionPool(MediaSessionPool):
+    def __init__(self, client, size: int, profile: Profile, file_sizes: dict):
+        super().__init__(client, size)
+        self.profile = profile
+        self.file_sizes = file_sizes
+
+    async def create_session(self, dc_id: int) -> FakeSession:
+        return FakeSession(self.profile, self.file_sizes)
+
+
+class FakeClient:
+    """
+    Enough of a pyrogram Client for ByteStreamer and the media session pool.
+    """
+
+    def __init__(self, client_id: int, profile: Profile, file_sizes: dict):
+        self.id = client_id
+        self.name = f"fake{client_id}"
+        self.media_sessions = {}
+        media_pools[self] = FakeMediaSessionPool(self, Server.MEDIA_SESSIONS_PER_DC, profile, file_sizes)
+
+
+def fake_file_id(media_id: int, dc_id: int = 2) -> str:
+    return FileId(
+        file_type=FileType.DOCUMENT, dc_id=dc_id, media_id=media_id, access_hash=media_id, file_reference=b""
+    ).encode()
@@ -0,0 +1,278 @@
+"""
+Offline benchmark of the /dl streaming path.
+
+Drives the real aiohttp app, media_streamer, ByteStreamer and media session
+pool against fake Telegram clients (see fake_telegram.py), so changes to
+custom_dl.py and stream_routes.py can be measured without live bots.
+
+    python -m benchmarks.stream_bench --profile all
+    python -m benchmarks.stream_bench --profile seek --latency 120 --clients 4
+"""
+import os
+import sys
+import json
+import time
+import logging
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+from aiohttp.test_utils import TestServer, TestClient
+from FileStream.bot import multi_clients, work_loads
+from FileStream.bot.scheduler import scheduler
+from FileStream.utils import file_properties
+from FileStream.utils.custom_dl import ByteStreamer
+from FileStream.utils.database import Database
+from FileStream.server import web_server, stream_routes
+from FileStream.server.shaping import shaper
+from benchmarks.fake_telegram import Profile, FakeClient, fake_file_id
+
+PROFILES = ("sequential", "seek", "fanout", "head")
+READ_SIZE = 64 * 1024
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+class Result:
+    def __init__(self, name: str):
+        self.name = name
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.ttfb = []
+        self.seconds = 0.0
+        self.getfile_calls = 0
+        self.flood_waits = 0
+        self.rss = 0
+        self.peak_rss = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "profile": self.name,
+            "requests": self.requests,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 3),
+            "throughput_mib_s": round(self.bytes / self.seconds / 1024 / 1024, 2) if self.seconds else 0,
+            "ttfb_p50_ms": round(percentile(self.ttfb, 0.5) * 1000, 2),
+            "ttfb_p99_ms": round(percentile(self.ttfb, 0.99) * 1000, 2),
+            "getfile_calls": self.getfile_calls,
+            "flood_waits": self.flood_waits,
+            "rss_mib": round(self.rss / 1024 / 1024, 1),
+            "peak_rss_mib": round(self.peak_rss / 1024 / 1024, 1),
+        }
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.file_size = int(args.file_size * 1024 * 1024)
+        self.profile = Profile(
+            latency=args.latency / 1000,
+            bandwidth=args.bandwidth * 1024 * 1024,
+            flood_rate=args.flood_rate,
+            flood_wait=args.flood_wait,
+            seed=args.seed,
+        )
+        self.file_sizes = {}
+        self.db_ids = []
+
+    async def setup(self):
+        # Local database in a scratch directory instead of FileStream/utils/database.json
+        self.tmp = tempfile.TemporaryDirectory()
+        database = Database()
+        database.db_path = os.path.join(self.tmp.name, "database.json")
+        database.log_path = database.db_path + ".log"
+        file_properties.db = stream_routes.db = database
+
+        # Every simulated viewer connects from 127.0.0.1
+        shaper.max_connections = 0
+
+        multi_clients.clear()
+        work_loads.clear()
+        for index in range(self.args.clients):
+            multi_clients[index] = FakeClient(index + 1, self.profile, self.file_sizes)
+            work_loads[index] = 0
+
+        for media_id in range(1, self.args.files + 1):
+            self.file_sizes[media_id] = self.file_size
+            _id = await database.add_file({
+                "user_id": 1,
+                "file_id": fake_file_id(media_id),
+                "file_unique_id": f"bench{media_id}",
+                "file_name": f"bench{media_id}.mp4",
+                "file_size": self.file_size,
+                "mime_type": "video/mp4",
+            })
+            await database.update_file_ids(_id, {
+                str(client.id): fake_file_id(media_id) for client in multi_clients.values()
+            })
+            self.db_ids.append(_id)
+
+        self.client = TestClient(TestServer(web_server()))
+        await self.client.start_server()
+
+    async def teardown(self):
+        await self.client.close()
+        self.tmp.cleanup()
+
+    def reset(self):
+        ByteStreamer.cached_file_ids.clear()
+        stream_routes.class_cache.clear()
+        scheduler.stats.clear()
+        self.profile.calls = self.profile.bytes = self.profile.flood_waits = 0
+
+    async def fetch(self, result: Result, db_id: str, headers: dict = None, limit: int = None, method: str = "GET"):
+        """
+        One request, reading at most `limit` bytes of the body before hanging up.
+        """
+        start = time.monotonic()
+        try:
+            async with self.client.request(method, f"/dl/{db_id}", headers=headers) as resp:
+                if resp.status >= 400:
+                    result.errors += 1
+                    return
+                if method == "HEAD":
+                    result.ttfb.append(time.monotonic() - start)
+                    return
+                received = 0
+                async for data in resp.content.iter_chunked(READ_SIZE):
+                    if not received:
+                        result.ttfb.append(time.monotonic() - start)
+                    received += len(data)
+                    if limit is not None and received >= limit:
+                        break
+                result.bytes += received
+                if limit is None and received != int(resp.headers["Content-Length"]):
+                    result.errors += 1
+        except Exception:
+            result.errors += 1
+        finally:
+            result.requests += 1
+
+    async def run_pool(self, jobs, concurrency: int):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(job):
+            async with semaphore:
+                await job
+
+        await asyncio.gather(*[run(job) for job in jobs])
+
+    def sequential(self, result: Result):
+        """
+        Whole-file downloads, cycling over the files.
+        """
+        return self.run_pool(
+            [self.fetch(result, self.db_ids[i % len(self.db_ids)]) for i in range(self.args.requests)],
+            self.args.concurrency,
+        )
+
+    def seek(self, result: Result):
+        """
+        Video players jumping around: open ranges at random offsets, each read
+        for a couple of MiB before the next seek.
+        """
+        jobs = []
+        for i in range(self.args.requests):
+            offset = self.random.randrange(0, self.file_size)
+            jobs.append(self.fetch(
+                result, self.db_ids[i % len(self.db_ids)], {"Range": f"bytes={offset}-"}, limit=self.args.seek_read * 1024 * 1024
+            ))
+        return self.run_pool(jobs, self.args.concurrency)
+
+    def fanout(self, result: Result):
+        """
+        Many viewers downloading the same hot file at once.
+        """
+        return self.run_pool([self.fetch(result, self.db_ids[0]) for _ in range(self.args.requests)], self.args.requests)
+
+    def head(self, result: Result):
+        """
+        Download managers and players probing with HEAD.
+        """
+        return self.run_pool(
+            [self.fetch(result, self.db_ids[i % len(self.db_ids)], method="HEAD") for i in range(self.args.requests * 20)],
+            self.args.concurrency * 4,
+        )
+
+    async def run(self, name: str) -> Result:
+        self.reset()
+        result = Result(name)
+        start = time.monotonic()
+        await getattr(self, name)(result)
+        result.seconds = time.monotonic() - start
+        result.getfile_calls = self.profile.calls
+        result.flood_waits = self.profile.flood_waits
+        result.rss = rss_bytes()
+        result.peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return result
+
+
+def print_table(results: list):
+    columns = (
+        ("profile", 11), ("requests", 9), ("errors", 7), ("throughput_mib_s", 17), ("ttfb_p50_ms", 12),
+        ("ttfb_p99_ms", 12), ("getfile_calls", 14), ("flood_waits", 12), ("peak_rss_mib", 13),
+    )
+    print("".join(name.ljust(width) for name, width in columns))
+    for result in results:
+        row = result.as_dict()
+        print("".join(str(row[name]).ljust(width) for name, width in columns))
+
+
+async def main(args):
+    if not args.verbose:
+        # Injected FloodWaits abort streams, which aiohttp logs with a traceback
+        logging.disable(logging.CRITICAL)
+    bench = Bench(args)
+    await bench.setup()
+    try:
+        results = []
+        for name in PROFILES if args.profile == "all" else (args.profile,):
+            results.append(await bench.run(name))
+    finally:
+        await bench.teardown()
+
+    if args.json:
+        json.dump([result.as_dict() for result in results], sys.stdout, indent=2)
+        print()
+    else:
+        print_table(results)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark /dl against fake Telegram clients.")
+    parser.add_argument("--profile", choices=PROFILES + ("all",), default="all")
+    parser.add_argument("--clients", type=int, default=2, help="fake bot clients")
+    parser.add_argument("--files", type=int, default=4, help="distinct files")
+    parser.add_argument("--file-size", type=float, default=32, help="MiB per file")
+    parser.add_argument("--requests", type=int, default=16, help="requests per profile")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--seek-read", type=int, default=2, help="MiB read after each seek")
+    parser.add_argument("--latency", type=float, default=50, help="ms per GetFile")
+    parser.add_argument("--bandwidth", type=float, default=8, help="MiB/s per media session")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probability of a FloodWait per GetFile")
+    parser.add_argument("--flood-wait", type=int, default=5, help="seconds of each injected FloodWait")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot and aiohttp logs")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))